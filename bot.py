@@ -1,144 +1,172 @@
 #!/usr/bin/env python3
 
-import _thread
-import base64
-import json
-import time
-import traceback
-import uuid
-from collections import deque
-
-import websocket
-
-from configs import ConfigBuilder
+import asyncio
+import re
+
+import json_codec
+from bounded_queue import BoundedQueue, OverflowPolicy, QueueWorker
+from configs import ConfigBuilder, config_for_rig, rig_name
+from curse_manager import CursesManager
+from data_structure.lazy_base64_blob import LazyBase64Blob
+from event_filter import EventFilter
+from handler_profiler import HandlerProfiler
+from html_telegram_bot import HTMLTelegramBot
 from log_writer import LogWriter
+from outbound_telegram_scheduler import OutboundTelegramScheduler
+from sequence_stat import StatPlotter
+from telegram import TelegramBot
 from voyager_client import VoyagerClient
+from voyager_connection_manager import VoyagerConnectionManager
 
 
-class VoyagerConnectionManager:
+class VoyagerRig:
     """
-    Low level class that maintains a live connection with voyager application server.
-    It allows command sending, keep-alive, reconnect, etc.
-    Logic to understand the content of each packet lives in 'VoyagerClient'.
-    TODO: Consider reverse the order of creation. Maybe let voyager client create an instance of connection manager.
+    Everything about a single voyager application server. Socket side lives in 'VoyagerConnectionManager' on the
+    shared asyncio event loop, event handling side lives in 'VoyagerClient' on this rig's own dispatch thread
+    and handler lanes, and the two only meet at a bounded ingest queue.
     """
 
-    def __init__(self, config=None):
+    def __init__(self, config=None, voyager_client: VoyagerClient = None, event_filter: EventFilter = None,
+                 name: str = ''):
         self.config = config
-        self.voyager_settings = self.config.voyager_setting
-
-        self.ws = None
-        self.keep_alive_thread = None
-        self.voyager_client = VoyagerClient(config=config)
-        self.command_queue = deque([])
-        self.ongoing_command = None
-        self.next_id = 1
-
-        self.log_writer = LogWriter(config=config)
-
-        self.reconnect_delay_sec = 1
-        self.should_exit_keep_alive_thread = False
-
-        self.command_uid_to_method_name_dict = {}
-
-    def send_command(self, command_name, params):
-        command_uuid = str(uuid.uuid1())
-        params['UID'] = command_uuid
-        command = {
-            'method': command_name,
-            'params': params,
-            'id': self.next_id
-        }
-        self.command_uid_to_method_name_dict[command_uuid] = command_name
-        self.next_id = self.next_id + 1
-        self.command_queue.append(command)
-        self.try_to_process_next_command()
-
-    def try_to_process_next_command(self):
-        if self.ongoing_command is not None:
-            print('wait a while before sending out the second command.')
-            # this command will be invoked later for sure
-            return
-
-        if len(self.command_queue) == 0:
-            return
-
-        command = self.command_queue.popleft()
-        self.ongoing_command = command
-        self.ws.send(json.dumps(command) + '\r\n')
-
-    def on_message(self, ws, message_string):
-        if not message_string or not message_string.strip():
-            # Empty message string, nothing to do
-            return
-
-        message = json.loads(message_string)
+        self.name = name
+
+        self.voyager_client = voyager_client
+        self.log_writer = LogWriter(config=config, log_name=re.sub(r'\W', '_', name))
+        self.event_filter = event_filter
+
+        # Receive stage only frames and enqueues messages, 'dispatch_worker' parses and handles them.
+        # 'put' runs on the event loop shared by every rig, blocking it would stall every socket and heartbeat.
+        overflow_policy = self.config.ingest_queue.overflow_policy
+        if overflow_policy == OverflowPolicy.BLOCK:
+            print(f'\n[VoyagerRig{name}] Ingest queue can\'t block the event loop, '
+                  f'using {OverflowPolicy.DROP_OLDEST} instead of {overflow_policy}')
+            overflow_policy = OverflowPolicy.DROP_OLDEST
+        self.ingest_queue = BoundedQueue(max_size=self.config.ingest_queue.max_size,
+                                         overflow_policy=overflow_policy, name=f'IngestQueue{name}')
+        self.dispatch_worker = QueueWorker(queue=self.ingest_queue, target=self.process_message,
+                                           name=f'DispatchWorker{name}')
+
+        self.connection_manager = VoyagerConnectionManager(config=config,
+                                                           receive_message_callback=self.on_message)
+
+    def on_message(self, message_string):
+        """
+        Receive stage, runs on the event loop. Keep it cheap: drop ignored events and enqueue the rest.
+        """
+        if self.event_filter.accept(message_string):
+            self.ingest_queue.put(message_string)
+
+    def process_message(self, message_string):
+        """
+        Dispatch stage, runs on the dispatch thread. Parses, logs and routes a single message to event handlers.
+        """
         self.log_writer.write_line(message_string)
 
+        base64_blob = None
+        if EventFilter.event_name(message_string) == 'NewJPGReady':
+            # Keep the preview out of the parser, handlers decode it only if they need it.
+            message_string, base64_blob = LazyBase64Blob.split_frame(message_string)
+
+        message = json_codec.loads(message_string)
+        if base64_blob is not None:
+            message['Base64Data'] = base64_blob
+
         if 'jsonrpc' in message:
-            # some command finished, try to see if we have anything else.
-            self.ongoing_command = None
-            self.try_to_process_next_command()
             self.voyager_client.parse_message('jsonrpc', message)
         else:
             event_name = message['Event']
             if event_name == 'RemoteActionResult':
-                uid = message['UID']
-                command_name = self.command_uid_to_method_name_dict.get(uid, 'NOT_FOUND')
-                message['MethodName'] = command_name
+                message['MethodName'] = self.connection_manager.method_name_for_uid(message['UID'])
             self.voyager_client.parse_message(event_name, message)
 
-    def on_error(self, ws, error):
-        self.log_writer.maybe_flush()
-        print(f'Error: {error} ###')
-        traceback.print_exc()
-
-    def on_close(self, ws, close_status_code, close_msg):
-        print(f'Closing connection, Code={close_status_code}, description= {close_msg}')
-        # try to reconnect with an exponentially increasing delay
-        if self.config.allow_auto_reconnect:
-            time.sleep(self.reconnect_delay_sec)
-            if self.reconnect_delay_sec < 512:
-                # doubles the reconnect delay so that we don't DOS server.
-                self.reconnect_delay_sec = self.reconnect_delay_sec * 2
-            # reset keep alive thread
-            self.should_exit_keep_alive_thread = True
-            self.keep_alive_thread = None
-            self.run_forever()
-
-    def on_open(self, ws):
-        # Reset the reconnection delay to 1 sec
-        self.reconnect_delay_sec = 1
-        if hasattr(self.voyager_settings, 'username'):
-            auth_token = f'{self.voyager_settings.username}:{self.voyager_settings.password}'
-            encoded_token = base64.urlsafe_b64encode(auth_token.encode('ascii'))
-            self.send_command('AuthenticateUserBase', {'Base': encoded_token.decode('ascii')})
-
-        self.send_command('RemoteSetDashboardMode', {'IsOn': True})
-        self.send_command('RemoteSetLogEvent', {'IsOn': True, 'Level': 0})
-        self.send_command('RemoteGetFilterConfiguration', {})
-        if self.keep_alive_thread is None:
-            self.should_exit_keep_alive_thread = False
-            self.keep_alive_thread = _thread.start_new_thread(self.keep_alive_routine, ())
+    def start(self):
+        self.voyager_client.start_handler_lanes()
+        self.dispatch_worker.start()
 
-    def run_forever(self):
-        self.ws = websocket.WebSocketApp(
-            'ws://{server_url}:{port}/'.format(server_url=self.voyager_settings.domain,
-                                               port=self.voyager_settings.port),
-            on_open=self.on_open,
-            on_message=self.on_message,
-            on_error=self.on_error,
-            on_close=self.on_close)
+    def stop(self):
+        self.dispatch_worker.stop()
+        self.voyager_client.stop_handler_lanes()
+        self.log_writer.close()
 
-        self.ws.run_forever()
 
-    def keep_alive_routine(self):
-        while not self.should_exit_keep_alive_thread:
-            self.ws.send('{"Event":"Polling","Timestamp":%d,"Inst":1}\r\n' % time.time())
-            time.sleep(5)
+class VoyagerBot:
+    """
+    Top level class of the bot. Monitors every rig in 'voyager_settings' from a single process:
+    connections of all rigs share one event loop, while the telegram bot, curses screen and stat plotter
+    are created once and shared. Handler state stays per rig.
+    """
+
+    def __init__(self, config=None):
+        self.config = config
+        print(f'Using JSON backend: {json_codec.use_backend(self.config.json_backend)}')
+
+        self.curses_manager = CursesManager()
+        if self.config.debugging:
+            self.telegram_bot = HTMLTelegramBot()
+        else:
+            self.telegram_bot = TelegramBot(config=config)
+        # Handlers only talk to the scheduler, which calls 'telegram_bot' on its own threads
+        self.telegram_scheduler = OutboundTelegramScheduler.from_config(config, self.telegram_bot)
+        self.stat_plotter = StatPlotter(plotter_configs=self.config.sequence_stats_config)
+
+        profiling_config = self.config.profiling
+        self.profiler = HandlerProfiler(output_dir=profiling_config.output_dir,
+                                        window_sec=profiling_config.window_sec,
+                                        top_frames=profiling_config.top_frames)
+        self.profiler.register_methods('StatPlotter', self.stat_plotter, ['plot'])
+        self.profiler.register_methods('TelegramBot', self.telegram_bot,
+                                       ['send_text_message', 'send_image_message', 'edit_image_message',
+                                        'pin_message', 'unpin_message', 'unpin_all_messages'])
+
+        voyager_settings = self.config.voyager_settings
+        self.event_filter = None
+        self.rigs = list()
+        for rig_index, voyager_setting in enumerate(voyager_settings):
+            name = rig_name(voyager_setting) if len(voyager_settings) > 1 else ''
+            rig_config = config_for_rig(config, voyager_setting, rig_label=name)
+            voyager_client = VoyagerClient(config=rig_config, telegram_bot=self.telegram_scheduler,
+                                           curses_manager=self.curses_manager, stat_plotter=self.stat_plotter,
+                                           monitor_local_battery=rig_index == 0)
+            if self.event_filter is None:
+                self.event_filter = self.create_event_filter(voyager_client)
+            self.profiler.register_voyager_client(voyager_client)
+            rig = VoyagerRig(config=rig_config, voyager_client=voyager_client, event_filter=self.event_filter,
+                             name=name)
+            self.curses_manager.add_rig(name, heartbeat_monitor=rig.connection_manager.heartbeat_monitor)
+            self.rigs.append(rig)
+
+    def create_event_filter(self, voyager_client: VoyagerClient) -> EventFilter:
+        # Events some handler explicitly asked for are never dropped, even if they are listed as ignored.
+        handled_event_names = voyager_client.handled_event_names()
+        kept_event_names = handled_event_names.intersection(self.config.ignored_events)
+        if kept_event_names:
+            print(f'Ignored events {sorted(kept_event_names)} are still received, since some handlers need them.')
+        event_filter = EventFilter(ignored_event_names=set(self.config.ignored_events) - handled_event_names)
+        self.curses_manager.update_ignored_event_counter(event_filter.dropped_counter)
+        return event_filter
+
+    async def run_all_connections(self):
+        await asyncio.gather(*[rig.connection_manager.run_forever() for rig in self.rigs])
+
+    def run_forever(self):
+        self.profiler.install_signal_handler()
+        for rig in self.rigs:
+            rig.start()
+        try:
+            asyncio.run(self.run_all_connections())
+        finally:
+            for rig in self.rigs:
+                rig.stop()
+            # Handlers flushed what they buffered into the scheduler on 'stop', give it a chance to go out
+            timeout_sec = self.config.shutdown.telegram_timeout_sec
+            if not self.telegram_scheduler.wait_until_idle(timeout_sec):
+                print(f'\n[VoyagerBot] {self.telegram_scheduler.backlog()} telegram messages were not sent '
+                      f'within {timeout_sec} sec, dropping them')
+            self.telegram_scheduler.stop()
 
 
 if __name__ == "__main__":
     config_builder = ConfigBuilder()
-    connection_manager = VoyagerConnectionManager(config=config_builder.build())
-    connection_manager.run_forever()
+    voyager_bot = VoyagerBot(config=config_builder.build())
+    voyager_bot.run_forever()
@@ -0,0 +1,193 @@
+#!/bin/env python3
+import threading
+import time
+import traceback
+from collections import deque
+from typing import Callable
+
+
+class OverflowPolicy:
+    """
+    What a 'BoundedQueue' does when a new item arrives and the queue is already full.
+    """
+    DROP_OLDEST = 'drop_oldest'  # Discard the oldest queued item to make room for the new one
+    DROP_NEWEST = 'drop_newest'  # Discard the incoming item, keep everything that is already queued
+    BLOCK = 'block'  # Block the producer until a consumer makes room
+
+    ALL = (DROP_OLDEST, DROP_NEWEST, BLOCK)
+
+
+class BoundedQueue:
+    """
+    A thread safe FIFO queue with a fixed capacity and a configurable overflow policy.
+    Producers never grow it beyond 'max_size', so a slow consumer can only cost us dropped items, not memory.
+
+    Items 'is_undroppable' returns True for are never dropped, they are queued even beyond 'max_size', and a full
+    queue drops its oldest droppable item instead. Keep them rare, they are the only way this queue can outgrow
+    'max_size'.
+    """
+
+    def __init__(self, max_size: int = 1000, overflow_policy: str = OverflowPolicy.DROP_OLDEST, name: str = 'Queue',
+                 is_undroppable: Callable = None):
+        if overflow_policy not in OverflowPolicy.ALL:
+            print(f'[{name}] Unknown overflow policy "{overflow_policy}", falling back to {OverflowPolicy.DROP_OLDEST}')
+            overflow_policy = OverflowPolicy.DROP_OLDEST
+
+        self.name = name
+        self.max_size = max(1, max_size)
+        self.overflow_policy = overflow_policy
+        self.is_undroppable = is_undroppable
+
+        self._items = deque()
+        self._lock = threading.Lock()
+        self._not_empty = threading.Condition(self._lock)
+        self._not_full = threading.Condition(self._lock)
+        self._all_done = threading.Condition(self._lock)
+        self._unfinished_count = 0  # queued items, plus the ones taken by a consumer and not marked done yet
+        self._closed = False
+
+        self.enqueued_count = 0
+        self.dropped_count = 0
+
+    def put(self, item) -> bool:
+        """
+        Enqueue an item according to the overflow policy.
+        :return: True if the item was queued, False if it was dropped.
+        """
+        with self._lock:
+            if self._closed:
+                return False
+
+            if len(self._items) >= self.max_size:
+                undroppable = self.is_undroppable is not None and self.is_undroppable(item)
+                if self.overflow_policy == OverflowPolicy.DROP_NEWEST:
+                    if not undroppable:
+                        self._count_dropped_item()
+                        return False
+                elif self.overflow_policy == OverflowPolicy.DROP_OLDEST:
+                    if not self._drop_oldest_droppable_item() and not undroppable:
+                        # Everything queued must be kept, so the new item goes instead
+                        self._count_dropped_item()
+                        return False
+                else:
+                    while len(self._items) >= self.max_size and not self._closed:
+                        self._not_full.wait()
+                    if self._closed:
+                        return False
+
+            self._items.append(item)
+            self._unfinished_count += 1
+            self.enqueued_count += 1
+            self._not_empty.notify()
+            return True
+
+    def get(self, timeout: float = None):
+        """
+        Dequeue the oldest item, waiting up to 'timeout' seconds (forever if None).
+        :return: The item, or None if the queue was closed or the wait timed out.
+        """
+        with self._lock:
+            if timeout is None:
+                while not self._items and not self._closed:
+                    self._not_empty.wait()
+            else:
+                deadline = time.monotonic() + timeout
+                while not self._items and not self._closed:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        return None
+                    self._not_empty.wait(remaining)
+
+            if not self._items:
+                return None
+
+            item = self._items.popleft()
+            self._not_full.notify()
+            return item
+
+    def _drop_oldest_droppable_item(self) -> bool:
+        """
+        Caller must hold '_lock'.
+        :return: False if every queued item is undroppable, and nothing was dropped.
+        """
+        if self.is_undroppable is None:
+            self._items.popleft()
+        else:
+            for index, queued_item in enumerate(self._items):
+                if not self.is_undroppable(queued_item):
+                    del self._items[index]
+                    break
+            else:
+                return False
+        self._unfinished_count -= 1
+        self._count_dropped_item()
+        return True
+
+    def _count_dropped_item(self):
+        self.dropped_count += 1
+        if self.dropped_count % 100 == 1:
+            print(f'\n[{self.name}] Queue is full, {self.dropped_count} items dropped so far.')
+
+    def task_done(self):
+        """Marks an item returned by 'get' as fully processed, see 'join'."""
+        with self._lock:
+            self._unfinished_count -= 1
+            if self._unfinished_count <= 0:
+                self._all_done.notify_all()
+
+    def join(self, timeout: float = None) -> bool:
+        """
+        Wait until every queued item was taken and marked done by 'task_done'.
+        :return: True if the queue is drained, False if it timed out.
+        """
+        with self._lock:
+            return self._all_done.wait_for(lambda: self._unfinished_count <= 0 or self._closed, timeout)
+
+    def backlog(self) -> int:
+        return len(self._items)
+
+    def unfinished_count(self) -> int:
+        """Number of items queued or being processed, see 'join'."""
+        return self._unfinished_count
+
+    def close(self):
+        """Wakes up all waiting producers and consumers, later 'put' calls are rejected."""
+        with self._lock:
+            self._closed = True
+            self._not_empty.notify_all()
+            self._not_full.notify_all()
+            self._all_done.notify_all()
+
+    @property
+    def closed(self) -> bool:
+        return self._closed
+
+
+class QueueWorker(threading.Thread):
+    """
+    A daemon thread that drains a 'BoundedQueue' and feeds every item to 'target', one at a time and in order.
+    """
+
+    def __init__(self, queue: BoundedQueue, target, name: str = 'QueueWorker'):
+        super().__init__(name=name, daemon=True)
+        self.queue = queue
+        self.target = target
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                if self.queue.closed:
+                    return
+                continue
+
+            try:
+                self.target(item)
+            except Exception as exception:
+                print(f'\n[{self.name}] Exception occurred while processing a queued item: {exception}')
+                traceback.print_exc()
+            finally:
+                self.queue.task_done()
+
+    def stop(self):
+        self.queue.close()
@@ -1,3 +1,4 @@
+import copy
 import os
 import platform
 import sys
@@ -49,12 +50,21 @@ After fixing that, try to open the exe file again.
                 self.config_yaml = {}
                 print(exc)
 
-        if 'chat_ids' in self.config_yaml['telegram_setting'] and len(self.config_yaml['telegram_setting']):
-            self.config_yaml['telegram_setting']['chat_id'] = self.config_yaml['telegram_setting']['chat_ids'][0]
+        # Messages go to every chat in 'chat_ids', a single 'chat_id' is the same as a list of one chat.
+        telegram_setting = self.config_yaml['telegram_setting']
+        if telegram_setting.get('chat_ids'):
+            telegram_setting['chat_id'] = telegram_setting['chat_ids'][0]
+        else:
+            telegram_setting['chat_ids'] = [telegram_setting['chat_id']]
+
+        # A single 'voyager_setting' is the same as a list of one rig.
+        if not self.config_yaml.get('voyager_settings'):
+            self.config_yaml['voyager_settings'] = [self.config_yaml['voyager_setting']]
 
         config_for_printing = self.config_yaml.copy()
         config_for_printing.pop('telegram_setting')
         config_for_printing.pop('voyager_setting')
+        config_for_printing.pop('voyager_settings')
 
         print('Loaded configuration:\n')
         print('<== Credentials for telegram and Voyager are hidden ==>')
@@ -70,6 +80,27 @@ After fixing that, try to open the exe file again.
         return class_from_dict('Configs', self.config_yaml.copy())()
 
 
+def config_for_rig(config, voyager_setting: dict, rig_label: str = ''):
+    """
+    Build the configuration of a single rig out of the shared configuration.
+    :param config: Configuration built by 'ConfigBuilder'
+    :param voyager_setting: One entry of 'voyager_settings'
+    :param rig_label: Prefix of the telegram messages about this rig, empty if there's only one rig
+    :return: A shallow copy of config, whose 'voyager_setting' is the given one
+    """
+    rig_config = copy.copy(config)
+    rig_config.voyager_setting = make_class('Configs_voyager_setting', **voyager_setting)()
+    rig_config.rig_label = rig_label
+    return rig_config
+
+
+def rig_name(voyager_setting: dict) -> str:
+    """
+    :return: Human readable name of a rig, its 'name' if set, otherwise domain and port.
+    """
+    return str(voyager_setting.get('name') or f'{voyager_setting["domain"]}:{voyager_setting["port"]}')
+
+
 def class_from_dict(name: str, dictionary: dict):
     nested_dict = {}
     for k, v in dictionary.items():
@@ -0,0 +1,35 @@
+#!/bin/env python3
+from typing import Dict, Optional
+
+# Synthetic event emitted by 'ControlDataCoalescer', it never comes from voyager application server.
+CONTROL_DATA_CHANGED = 'ControlDataChanged'
+
+
+class ControlDataCoalescer:
+    """
+    Dashboard mode sends a 'ControlData' event every couple of seconds, and the rig state in it (what is running,
+    guiding, tracking...) stays the same for most of a night. This keeps the last known state and turns consecutive
+    'ControlData' events into state deltas: 'coalesce' only returns a 'ControlDataChanged' event when some state
+    field changed. Per-sample fields like guide errors are not state, they are still delivered by 'ControlData'.
+    """
+
+    # Fields of 'ControlData' describing the state of the rig, the ones consumers care about changes of.
+    STATE_FIELDS = ('GUIDESTAT', 'DITHSTAT', 'MNTTRACK', 'MNTSLEW', 'RUNSEQ', 'RUNDS')
+
+    def __init__(self):
+        self.state = dict()
+
+    def coalesce(self, message: Dict) -> Optional[Dict]:
+        """
+        :param message: A 'ControlData' message
+        :return: A 'ControlDataChanged' message with 'Changed' (only the fields that changed) and 'State'
+        (all state fields), or None if the state is the same as in the previous 'ControlData'.
+        """
+        changed_fields = {field: message[field] for field in self.STATE_FIELDS
+                          if field in message and self.state.get(field) != message[field]}
+        if not changed_fields:
+            return None
+
+        self.state.update(changed_fields)
+        return {'Event': CONTROL_DATA_CHANGED, 'Timestamp': message.get('Timestamp'),
+                'Changed': changed_fields, 'State': dict(self.state)}
@@ -1,4 +1,5 @@
 import curses
+import threading
 import time
 from collections import deque
 
@@ -6,6 +7,7 @@ from data_structure.error_message_info import ErrorMessageInfo
 from data_structure.host_info import HostInfo
 from data_structure.job_status_info import JobStatusInfo, GuideStatEnum, DitherStatEnum
 from data_structure.log_message_info import LogMessageInfo
+from data_structure.rig_screen_state import RigScreenState
 from data_structure.special_battery_percentage import SpecialBatteryPercentageEnum
 from version import bot_version_string
 
@@ -34,13 +36,25 @@ class CursesManager:
 
         # status information used to update info
         self.last_error = ErrorMessageInfo()
-        self.received_message_counter = 0
-        self.host_info = HostInfo()
+        self.ignored_event_counter = dict()
+        self.handler_lanes = list()
+        self.rig_states = dict()  # rig label => RigScreenState, in the order rigs were added
         self.log_queue = deque(maxlen=10)
         self.battery_percentage = 100
-        self.job_status_info = JobStatusInfo()
+
+        # Screen is shared by the dispatch threads and handler lanes of all rigs. Every change of the state above,
+        # and every redraw, happens under this lock, so a redraw never sees a half-made change.
+        self.screen_lock = threading.RLock()
+        # Message counter alone changes with every message, so it redraws the screen at most this often
+        self.counter_refresh_interval_sec = 1.0
+        self.last_draw_time = 0.0
 
     def _update_whole_scr(self):
+        with self.screen_lock:
+            self.last_draw_time = time.monotonic()
+            self._draw_whole_scr()
+
+    def _draw_whole_scr(self):
         self.stdscr.clear()
         line_pos = 0
 
@@ -49,9 +63,13 @@ class CursesManager:
         line_pos += 1
 
         # Version and Host Information
+        rig_states = list(self.rig_states.items())
         self.stdscr.addstr(line_pos, 0, f'|     VoyagerTelegramBot v{bot_version_string()}     |', self.normal_style)
-        host_str = f'{self.host_info.url}:{self.host_info.port} ({self.host_info.host_name})'
-        self.stdscr.addstr(f' {host_str:54} | Battery |', self.normal_style)
+        if len(rig_states) == 1:
+            host_str = self._host_str(rig_states[0][1].host_info)
+        else:
+            host_str = f'Monitoring {len(rig_states)} rigs'
+        self.stdscr.addstr(f' {host_str:54.54} | Battery |', self.normal_style)
 
         # Battery Info
         if self.battery_percentage == SpecialBatteryPercentageEnum.ON_AC_POWER:
@@ -91,37 +109,14 @@ class CursesManager:
         self.stdscr.addstr(line_pos, 0, '+' + '-' * 118 + '+', self.normal_style)
         line_pos += 1
 
-        # Job Detail
-        self.stdscr.addstr(line_pos, 0, f'| DragScript | {self.job_status_info.drag_script_name:27} |', self.normal_style)
-        self.stdscr.addstr(f' Sequence | {self.job_status_info.sequence_name:27} | ', self.normal_style)
-
-        if self.job_status_info.is_slewing:
-            motion_str = 'SLEWING'
-            self.stdscr.addstr(f'{motion_str:8}', self.safe_style)
-        elif self.job_status_info.is_tracking:
-            motion_str = 'TRACKING'
-            self.stdscr.addstr(f'{motion_str:8}', self.safe_style)
-        else:
-            motion_str = ''
-            self.stdscr.addstr(f'{motion_str:8}', self.safe_style)
-        
-        self.stdscr.addstr(' | ', self.normal_style)
-        if self.job_status_info.guide_status == GuideStatEnum.STOPPED:
-            self.stdscr.addstr(f' STOPPED ', self.critical_style)
-        elif self.job_status_info.guide_status == GuideStatEnum.RUNNING:
-            self.stdscr.addstr(f' GUIDING ', self.safe_style)
-        else:
-            self.stdscr.addstr(f' WAITING ', self.warning_style)
-        self.stdscr.addstr(' | ', self.normal_style)
-
-        if self.job_status_info.dither_status == DitherStatEnum.STOPPED:
-            self.stdscr.addstr(f' STOPPED ', self.critical_style)
-        elif self.job_status_info.dither_status == DitherStatEnum.RUNNING:
-            self.stdscr.addstr(f'DITHERING', self.safe_style)
-        else:
-            self.stdscr.addstr(f' WAITING ', self.warning_style)
-        self.stdscr.addstr(' |', self.normal_style)
-        line_pos += 1
+        # Job Detail, one section for each rig
+        for rig_label, rig_state in rig_states:
+            if len(rig_states) > 1:
+                rig_str = f'{rig_label}: {self._host_str(rig_state.host_info)}'
+                self.stdscr.addstr(line_pos, 0, f'| {rig_str:116.116} |', self.normal_style)
+                line_pos += 1
+            self._draw_job_status(line_pos, rig_state.job_status_info)
+            line_pos += 1
 
         # Horizontal Line
         self.stdscr.addstr(line_pos, 0, '+' + '-' * 118 + '+', self.normal_style)
@@ -145,49 +140,148 @@ class CursesManager:
         line_pos += 1
 
         # Message Counter
-        counter_str = f'{self.received_message_counter} messages have been processed...'
+        counter_str = ', '.join(f'{rig_label}: {rig_state.received_message_counter}' if rig_label
+                                else str(rig_state.received_message_counter) for rig_label, rig_state in rig_states)
+        counter_str = f'{counter_str or 0} messages have been processed...'
+        if self.ignored_event_counter:
+            ignored_str = ', '.join(f'{name}: {count}' for name, count in list(self.ignored_event_counter.items()))
+            counter_str += f' Ignored: {ignored_str}'
+        lane_strs = list()
+        for lane in list(self.handler_lanes):
+            backlog, dropped_count = lane.backlog(), lane.dropped_count()
+            if backlog or dropped_count:
+                lane_str = f'{lane.handler_name}: {backlog}'
+                lane_strs.append(f'{lane_str} ({dropped_count} dropped)' if dropped_count else lane_str)
+        if lane_strs:
+            counter_str += f' Backlog: {", ".join(lane_strs)}'
         self.stdscr.addstr(line_pos, 0, f'| {counter_str:116.116} |', self.normal_style)
         line_pos += 1
 
+        # Heartbeat RTT
+        rtt_strs = list()
+        for rig_label, rig_state in rig_states:
+            if rig_state.heartbeat_monitor is not None:
+                last_rtt, average_rtt, max_rtt = rig_state.heartbeat_monitor.rtt_stats()
+                rtt_str = f'{last_rtt * 1000:.0f}/{average_rtt * 1000:.0f}/{max_rtt * 1000:.0f} ms'
+                rtt_strs.append(f'{rig_label} {rtt_str}' if rig_label else rtt_str)
+        if rtt_strs:
+            rtt_str = 'Heartbeat RTT last/avg/max: ' + ', '.join(rtt_strs)
+            self.stdscr.addstr(line_pos, 0, f'| {rtt_str:116.116} |', self.normal_style)
+            line_pos += 1
+
         # Horizontal Line
         self.stdscr.addstr(line_pos, 0, '+' + '-' * 118 + '+', self.normal_style)
 
         self.stdscr.refresh()
 
-    def update_message_counter(self, counter_number: int = 0):
-        self.received_message_counter = counter_number
-        self._update_whole_scr()
+    @staticmethod
+    def _host_str(host_info: HostInfo) -> str:
+        return f'{host_info.url}:{host_info.port} ({host_info.host_name})'
+
+    def _draw_job_status(self, line_pos: int, job_status_info: JobStatusInfo):
+        self.stdscr.addstr(line_pos, 0, f'| DragScript | {job_status_info.drag_script_name:27} |', self.normal_style)
+        self.stdscr.addstr(f' Sequence | {job_status_info.sequence_name:27} | ', self.normal_style)
+
+        if job_status_info.is_slewing:
+            motion_str = 'SLEWING'
+            self.stdscr.addstr(f'{motion_str:8}', self.safe_style)
+        elif job_status_info.is_tracking:
+            motion_str = 'TRACKING'
+            self.stdscr.addstr(f'{motion_str:8}', self.safe_style)
+        else:
+            motion_str = ''
+            self.stdscr.addstr(f'{motion_str:8}', self.safe_style)
+        
+        self.stdscr.addstr(' | ', self.normal_style)
+        if job_status_info.guide_status == GuideStatEnum.STOPPED:
+            self.stdscr.addstr(f' STOPPED ', self.critical_style)
+        elif job_status_info.guide_status == GuideStatEnum.RUNNING:
+            self.stdscr.addstr(f' GUIDING ', self.safe_style)
+        else:
+            self.stdscr.addstr(f' WAITING ', self.warning_style)
+        self.stdscr.addstr(' | ', self.normal_style)
+
+        if job_status_info.dither_status == DitherStatEnum.STOPPED:
+            self.stdscr.addstr(f' STOPPED ', self.critical_style)
+        elif job_status_info.dither_status == DitherStatEnum.RUNNING:
+            self.stdscr.addstr(f'DITHERING', self.safe_style)
+        else:
+            self.stdscr.addstr(f' WAITING ', self.warning_style)
+        self.stdscr.addstr(' |', self.normal_style)
+
+    def rig_state(self, rig_label: str) -> RigScreenState:
+        """
+        Caller must hold 'screen_lock'.
+        """
+        if rig_label not in self.rig_states:
+            self.rig_states[rig_label] = RigScreenState()
+        return self.rig_states[rig_label]
+
+    def update_message_counter(self, counter_number: int = 0, rig_label: str = ''):
+        with self.screen_lock:
+            self.rig_state(rig_label).received_message_counter = counter_number
+            if time.monotonic() - self.last_draw_time >= self.counter_refresh_interval_sec:
+                self._update_whole_scr()
+
+    def update_ignored_event_counter(self, ignored_event_counter: dict = None):
+        """
+        Keeps a reference to a live counter of ignored events, it is shown the next time the screen is updated.
+        """
+        with self.screen_lock:
+            self.ignored_event_counter = ignored_event_counter
+
+    def add_handler_lanes(self, handler_lanes):
+        """
+        Shows the backlog and dropped events of these handler lanes, for every lane that has any, the next time
+        the screen is updated.
+        """
+        with self.screen_lock:
+            self.handler_lanes.extend(handler_lanes)
+
+    def add_rig(self, rig_label: str = '', heartbeat_monitor=None):
+        """
+        Gives this rig its own section on the screen, and shows the heartbeat RTT of its connection.
+        Rigs are shown in the order they were added.
+        """
+        with self.screen_lock:
+            self.rig_state(rig_label).heartbeat_monitor = heartbeat_monitor
 
     def update_lass_error(self, error_info: ErrorMessageInfo = None):
         if error_info:
-            self.last_error = error_info
-            self._update_whole_scr()
+            with self.screen_lock:
+                self.last_error = error_info
+                self._update_whole_scr()
 
-    def update_host_info(self, host_info: HostInfo = None):
-        self.host_info = host_info
-        self._update_whole_scr()
+    def update_host_info(self, host_info: HostInfo = None, rig_label: str = ''):
+        with self.screen_lock:
+            self.rig_state(rig_label).host_info = host_info
+            self._update_whole_scr()
 
     def update_battery_percentage(self, battery_percentage: int = 0, update: bool = True):
-        self.battery_percentage = battery_percentage
-        if update:
-            self._update_whole_scr()
+        with self.screen_lock:
+            self.battery_percentage = battery_percentage
+            if update:
+                self._update_whole_scr()
 
     def append_log(self, new_message: LogMessageInfo = None):
         if new_message:
-            self.log_queue.append(new_message)
-            self._update_whole_scr()
+            with self.screen_lock:
+                self.log_queue.append(new_message)
+                self._update_whole_scr()
 
-    def update_job_status_info(self, job_status_info: JobStatusInfo = None):
+    def update_job_status_info(self, job_status_info: JobStatusInfo = None, rig_label: str = ''):
         if job_status_info:
-            self.job_status_info = job_status_info
-            self._update_whole_scr()
+            with self.screen_lock:
+                self.rig_state(rig_label).job_status_info = job_status_info
+                self._update_whole_scr()
 
     def close(self):
         # Close the screen
-        curses.nocbreak()
-        self.stdscr.keypad(False)
-        curses.echo()
-        curses.endwin()
+        with self.screen_lock:
+            curses.nocbreak()
+            self.stdscr.keypad(False)
+            curses.echo()
+            curses.endwin()
 
 
 if __name__ == '__main__':
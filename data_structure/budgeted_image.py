@@ -0,0 +1,36 @@
+import threading
+
+from data_structure.lazy_base64_blob import image_bytes
+from preview_encoder import PreviewEncoder
+
+
+class BudgetedImage:
+    """
+    An image that is re-encoded by a 'PreviewEncoder' the first time its bytes are needed, which is on the thread
+    that uploads it, not on the thread of the handler that sent it. The result is cached, so every chat shares it.
+    The original stays available as 'original'.
+    """
+
+    __slots__ = ('original', 'encoder', '_encoded', '_lock')
+
+    def __init__(self, original, encoder: PreviewEncoder):
+        """
+        :param original: Raw image bytes, or anything 'image_bytes' accepts
+        """
+        self.original = original
+        self.encoder = encoder
+        self._encoded = None
+        self._lock = threading.Lock()
+
+    def decode(self):
+        """
+        :return: Raw bytes of the re-encoded image.
+        """
+        if self._encoded is None:
+            with self._lock:
+                if self._encoded is None:
+                    self._encoded = self.encoder.encode(image_bytes(self.original))
+        return self._encoded
+
+    def __repr__(self):
+        return f'<BudgetedImage of {self.original!r}>'
@@ -1,4 +1,20 @@
+FILTER_ALIAS = {
+    'Ha': ['H', 'Ha', 'H-Alpha'],
+    'SII': ['S', 'S2', 'SII', 'S-II'],
+    'OIII': ['O', 'O3', 'OIII', 'O-III'],
+    'L': ['L', 'Lum', 'Luminance'],
+    'R': ['R', 'Red'],
+    'G': ['G', 'Green'],
+    'B': ['B', 'Blue']
+}
+
+# Upper case alias => normalized filter name, built once instead of for every exposure
+FILTER_MAPPING = {alias.upper(): filter_key for filter_key, aliases in FILTER_ALIAS.items() for alias in aliases}
+
+
 class ExposureInfo:
+    __slots__ = ('_filter_name', 'exposure_time', 'hfd', 'star_index', 'timestamp', 'sequence_name')
+
     def __init__(self, filter_name: str = '', exposure_time: int = 0, hfd: float = 0, star_index: float = 0,
                  timestamp: float = 0, sequence_name: str = ''):
         self._filter_name = None
@@ -16,23 +32,8 @@ class ExposureInfo:
 
     @filter_name.setter
     def filter_name(self, value: str = 'L'):
-        filter_alias = {
-            'Ha': ['H', 'Ha', 'H-Alpha'],
-            'SII': ['S', 'S2', 'SII', 'S-II'],
-            'OIII': ['O', 'O3', 'OIII', 'O-III'],
-            'L': ['L', 'Lum', 'Luminance'],
-            'R': ['R', 'Red'],
-            'G': ['G', 'Green'],
-            'B': ['B', 'Blue']
-        }
-
-        filter_mapping = dict()
-        for filter_key in filter_alias:
-            for alias in filter_alias[filter_key]:
-                filter_mapping[alias.upper()] = filter_key
-
-        if value.upper() in filter_mapping:
-            self._filter_name = filter_mapping[value.upper()]
+        if value.upper() in FILTER_MAPPING:
+            self._filter_name = FILTER_MAPPING[value.upper()]
         else:
             # Keep original filter name if no mapping can be found
             self._filter_name = 'UNKNOWN-' + value
@@ -0,0 +1,77 @@
+import base64
+import re
+import threading
+from typing import Tuple, Union
+
+
+class LazyBase64Blob:
+    """
+    A base64 payload that still lives inside the raw frame it arrived with. Nothing is copied or decoded until
+    'decode' is called, and the decoded bytes are cached and shared by every handler that touches it.
+    Once decoded, the blob lets go of the frame, so a preview never costs the frame and the decoded bytes at once.
+    The decoded bytes are freed by reference counting as soon as the last message dict holding this blob goes away.
+    """
+
+    VALUE_START_PATTERN = re.compile(r'"Base64Data"\s*:\s*"')
+
+    __slots__ = ('_source', '_start', '_end', '_length', '_decoded', '_lock')
+
+    def __init__(self, source: str, start: int, end: int):
+        self._source = source
+        self._start = start
+        self._end = end
+        self._length = end - start
+        self._decoded = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def split_frame(cls, message_string: str) -> Tuple[str, Union['LazyBase64Blob', None]]:
+        """
+        Cut the 'Base64Data' value out of a raw frame, so that it can be parsed without materializing the payload.
+        :return: Tuple of the frame with an empty 'Base64Data' value, and the blob (None if there is no payload)
+        """
+        match = cls.VALUE_START_PATTERN.search(message_string)
+        if not match:
+            return message_string, None
+
+        value_start = match.end()
+        value_end = message_string.find('"', value_start)
+        if value_end == -1:
+            return message_string, None
+
+        blob = cls(source=message_string, start=value_start, end=value_end)
+        return message_string[:value_start] + message_string[value_end:], blob
+
+    def decode(self) -> bytes:
+        """
+        :return: The decoded payload. Decoded at most once, even if several handlers ask for it at the same time.
+        """
+        if self._decoded is None:
+            with self._lock:
+                if self._decoded is None:
+                    encoded = self._source[self._start:self._end]
+                    if '\\' in encoded:
+                        # JSON allows escaping '/', which is a valid base64 character
+                        encoded = encoded.replace('\\/', '/')
+                    self._decoded = base64.b64decode(encoded)
+                    # The whole multi-megabyte frame is not needed anymore
+                    self._source = ''
+                    self._start = self._end = 0
+        return self._decoded
+
+    def __len__(self):
+        return self._length
+
+    def __repr__(self):
+        return f'<LazyBase64Blob {len(self)} base64 chars>'
+
+
+def image_bytes(image) -> Union[bytes, memoryview]:
+    """
+    Media is passed around as raw bytes (or a memoryview of them), or as an object producing them on demand with
+    'decode', like 'LazyBase64Blob' for previews from voyager, or 'BudgetedImage'.
+    :return: Raw bytes of an image, the given bytes themselves if they already are.
+    """
+    if isinstance(image, (bytes, bytearray, memoryview)):
+        return image
+    return image.decode()
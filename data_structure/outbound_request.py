@@ -0,0 +1,12 @@
+from concurrent.futures import Future
+from dataclasses import dataclass, field
+
+
+@dataclass
+class OutboundRequest:
+    method_name: str  # name of the 'TelegramBot' method to call
+    args: tuple
+    kwargs: dict
+    future: Future = field(default_factory=Future)
+    attempt: int = 0  # how many times this request has been retried after a transient failure
+    rate_limited_wait_sec: float = 0  # how long this request has waited on 429 answers so far
@@ -0,0 +1,10 @@
+from asyncio import Future, TimerHandle
+from dataclasses import dataclass
+
+
+@dataclass
+class PendingCommand:
+    command: dict
+    future: Future
+    attempt: int = 0  # how many times this command has been re-sent after a timeout
+    timeout_handle: TimerHandle = None
@@ -0,0 +1,15 @@
+from dataclasses import dataclass, field
+
+from data_structure.host_info import HostInfo
+from data_structure.job_status_info import JobStatusInfo
+
+
+@dataclass
+class RigScreenState:
+    """
+    What the curses screen shows about a single rig.
+    """
+    received_message_counter: int = 0
+    host_info: HostInfo = field(default_factory=HostInfo)
+    job_status_info: JobStatusInfo = field(default_factory=JobStatusInfo)
+    heartbeat_monitor: object = None  # 'HeartbeatMonitor' of the rig's connection, if it has one
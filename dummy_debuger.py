@@ -1,4 +1,5 @@
-from bot import VoyagerConnectionManager
+from bot import VoyagerBot
+from bounded_queue import OverflowPolicy
 from configs import ConfigBuilder
 
 
@@ -9,7 +10,14 @@ class DummyDebugger:
         config = config_builder.build()
         config.debugging = True
         config.should_dump_log = False
-        self.connection_manager = VoyagerConnectionManager(config=config)
+        # Replay is much faster than a real night, wait for slow handlers instead of dropping their events
+        config.handler_lanes.overflow_policy = OverflowPolicy.BLOCK
+        # HTML output has no rate limit to respect
+        config.telegram_rate_limit.global_messages_per_sec = 1000
+        config.telegram_rate_limit.chat_messages_per_sec = 1000
+        self.voyager_bot = VoyagerBot(config=config)
+        for rig in self.voyager_bot.rigs:
+            rig.start()
 
     def load_messages(self, msg_fn: str = None):
         with open(msg_fn, 'r') as msg_f:
@@ -17,10 +25,18 @@ class DummyDebugger:
 
     def dummy_send(self):
         for msg in self.messages:
-            self.connection_manager.on_message(ws=None, message_string=msg.strip())
+            message_string = msg.strip()
+            if message_string and self.voyager_bot.event_filter.accept(message_string):
+                # Skip the ingest queue, so that no message is dropped however fast they are replayed
+                self.voyager_bot.rigs[0].process_message(message_string)
 
     def good_night(self):
-        self.connection_manager.voyager_client.telegram_bot.write_footer()
+        for rig in self.voyager_bot.rigs:
+            # Handlers run on their own lanes, let them finish before the footer is written
+            rig.voyager_client.wait_until_idle()
+            rig.stop()
+        self.voyager_bot.telegram_scheduler.wait_until_idle()
+        self.voyager_bot.telegram_bot.write_footer()
 
 
 if __name__ == "__main__":
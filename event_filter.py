@@ -0,0 +1,40 @@
+#!/bin/env python3
+import re
+from collections import Counter
+from typing import Iterable, Optional
+
+
+class EventFilter:
+    """
+    Drops ignored events right at the receive stage, before they are parsed, logged or dispatched.
+    The event name is recognised from the head of the raw frame with a single bounded regex search,
+    since voyager always puts the 'Event' key first.
+    """
+
+    EVENT_NAME_PATTERN = re.compile(r'"Event"\s*:\s*"([^"]*)"')
+    EVENT_NAME_SEARCH_LENGTH = 64  # Only look at the head of a frame, previews are megabytes long.
+
+    def __init__(self, ignored_event_names: Iterable[str] = None):
+        self.ignored_event_names = frozenset(ignored_event_names or [])
+        self.dropped_counter = Counter()  # event name => number of frames dropped
+
+    @classmethod
+    def event_name(cls, message_string: str) -> Optional[str]:
+        """
+        :return: Event name of a raw frame, or None if it is not an event (e.g. a 'jsonrpc' reply).
+        """
+        match = cls.EVENT_NAME_PATTERN.search(message_string, 0, cls.EVENT_NAME_SEARCH_LENGTH)
+        return match.group(1) if match else None
+
+    def accept(self, message_string: str) -> bool:
+        """
+        :return: False if the frame is an ignored event and should be dropped.
+        """
+        if not self.ignored_event_names:
+            return True
+
+        event_name = self.event_name(message_string)
+        if event_name in self.ignored_event_names:
+            self.dropped_counter[event_name] += 1
+            return False
+        return True
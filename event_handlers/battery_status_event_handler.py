@@ -4,8 +4,8 @@ import psutil
 
 from curse_manager import CursesManager
 from data_structure.special_battery_percentage import SpecialBatteryPercentageEnum
-from event_handlers.voyager_event_handler import VoyagerEventHandler
-from telegram import TelegramBot
+from event_handlers.voyager_event_handler import VoyagerEventHandler, handles
+from outbound_telegram_scheduler import OutboundTelegramScheduler
 
 
 class BatteryStatusEventHandler(VoyagerEventHandler):
@@ -13,24 +13,31 @@ class BatteryStatusEventHandler(VoyagerEventHandler):
     An event handler which is interested in local -- the bot's local, not voyager application's local, battery status.
     """
 
-    def __init__(self, config, telegram_bot: TelegramBot, curses_manager: CursesManager):
+    def __init__(self, config, telegram_bot: OutboundTelegramScheduler, curses_manager: CursesManager):
         super().__init__(config=config, telegram_bot=telegram_bot,
                          handler_name='BatteryStatusEventHandler',
                          curses_manager=curses_manager)
         self.throttle_count = 0  # A throttle counter, limits the frequency of sending local battery alerts.
+        self.battery_available = self.check_battery_availability()
 
-    def interested_event_names(self):
+    def check_battery_availability(self) -> bool:
         try:
-            battery = psutil.sensors_battery()
-            if battery is None:
-                self.curses_manager.update_battery_percentage(SpecialBatteryPercentageEnum.NOT_AVAILABLE, update=False)
-                return list()
-            return ['LogEvent', 'ShotRunning', 'ControlData']
-        except Exception as exception:
-            self.curses_manager.update_battery_percentage(SpecialBatteryPercentageEnum.NOT_AVAILABLE, update=False)
-            return list()
-
-    def handle_event(self, event_name: str, message: Dict):
+            if psutil.sensors_battery() is not None:
+                return True
+        except Exception:
+            pass
+        self.curses_manager.update_battery_percentage(SpecialBatteryPercentageEnum.NOT_AVAILABLE, update=False)
+        return False
+
+    def routes(self):
+        # Without a battery there is nothing to monitor, don't even get called.
+        return super().routes() if self.battery_available else list()
+
+    # On raw 'ControlData' rather than 'ControlDataChanged': the rig state barely changes during a night,
+    # and the alert can't wait for it. 'ControlData' arrives every couple of seconds, which keeps the throttled
+    # alert to about once a minute.
+    @handles('LogEvent', 'ShotRunning', 'ControlData')
+    def check_battery(self, message: Dict):
         battery_msg = ''
         if not self.config.monitor_battery:
             self.curses_manager.update_battery_percentage(SpecialBatteryPercentageEnum.NOT_MONITORED, update=False)
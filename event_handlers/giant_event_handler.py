@@ -1,55 +1,65 @@
+import hashlib
+import threading
+from concurrent.futures import Future
+from functools import partial
 from typing import Dict
 
+from control_data_coalescer import CONTROL_DATA_CHANGED
 from curse_manager import CursesManager
+from data_structure.budgeted_image import BudgetedImage
 from data_structure.filter_info import ExposureInfo
 from data_structure.focus_result import FocusResult
 from data_structure.job_status_info import GuideStatEnum, DitherStatEnum, JobStatusInfo
-from event_handlers.voyager_event_handler import VoyagerEventHandler
+from event_handlers.voyager_event_handler import VoyagerEventHandler, handles
+from outbound_telegram_scheduler import OutboundTelegramScheduler
+from preview_encoder import PreviewEncoder
 from sequence_stat import StatPlotter, SequenceStat
-from telegram import TelegramBot
 
 
 class GiantEventHandler(VoyagerEventHandler):
-    def __init__(self, config, telegram_bot: TelegramBot, curses_manager: CursesManager):
+    def __init__(self, config, telegram_bot: OutboundTelegramScheduler, curses_manager: CursesManager,
+                 stat_plotter: StatPlotter = None):
         super().__init__(config=config, telegram_bot=telegram_bot,
                          handler_name='GiantEventHandler',
                          curses_manager=curses_manager)
 
-        self.stat_plotter = StatPlotter(plotter_configs=self.config.sequence_stats_config)
+        self.stat_plotter = stat_plotter or StatPlotter(plotter_configs=self.config.sequence_stats_config)
 
         self.running_seq = ''
         self.running_dragscript = ''
 
         self.shot_running = False  # whether the camera is exposing, inferred from 'ShotRunning' event
+        self.guide_status = GuideStatEnum.STOPPED  # from the latest 'ControlDataChanged' event
+        self.dither_status = DitherStatEnum.STOPPED
 
         # A dictionary of 'sequence name' => 'sequence stats'
         self.sequence_map = dict()
 
-        self.current_sequence_stat_chat_id = None
-        self.current_sequence_stat_message_id = None
+        self.current_sequence_stat_message_ids = dict()  # chat id => message id of the statistics message
+        # Set while the statistics message is on its way, from then on it's edited in place. Guarded by the lock,
+        # since the message is sent and pinned on the thread of the outbound telegram scheduler.
+        self.current_sequence_stat_future = None
+        self.pending_stats_image = None  # latest image of reports made while the statistics message was on its way
+        # (sequence name, version) of the stats last rendered and submitted, unchanged stats are neither rendered nor
+        # sent again. Guarded by the lock, and cleared when telegram fails to show them, so that they are retried.
+        self.reported_stats_version = None
+        self.sent_stats_digest = None  # digest of the image the statistics message shows, guarded by the lock
+        # Reentrant, since callbacks of requests that already failed run right away, with the lock still held
+        self.stats_message_lock = threading.RLock()
+        # Held from checking 'reported_stats_version' until it's recorded, so the same stats are rendered once.
+        # Apart from 'stats_message_lock', so that telegram callbacks don't wait for a render.
+        self.stats_report_lock = threading.Lock()
 
         self.filter_name_list = [i for i in range(10)]  # initial with 10 unnamed filters
 
-    def interested_event_names(self):
-        return ['NewJPGReady',
-                'AutoFocusResult',
-                'ShotRunning',
-                'ControlData',
-                'RemoteActionResult']
-
-    def handle_event(self, event_name: str, message: Dict):
-        if event_name == 'NewJPGReady':
-            self.handle_jpg_ready(message)
-        elif event_name == 'AutoFocusResult':
-            self.handle_focus_result(message)
-        elif event_name == 'ShotRunning':
-            self.handle_shot_running(message)
-        elif event_name == 'ControlData':
-            self.handle_control_data(message)
-        elif event_name == 'RemoteActionResult':
-            self.handle_remote_action_result(message)
-        else:
-            return
+        preview_budget_config = self.config.preview_budget
+        self.preview_encoder = None  # previews are sent as they are when there's no budget
+        if preview_budget_config.enabled and not preview_budget_config.send_original:
+            self.preview_encoder = PreviewEncoder(max_dimension=preview_budget_config.max_dimension,
+                                                  quality=preview_budget_config.jpeg_quality,
+                                                  min_quality=preview_budget_config.min_jpeg_quality,
+                                                  progressive=preview_budget_config.progressive,
+                                                  max_bytes=preview_budget_config.max_bytes)
 
     def handle_version(self, message: Dict):
         telegram_message = 'Connected to <b>{host_name}({url})</b> [{version}]'.format(
@@ -59,6 +69,7 @@ class GiantEventHandler(VoyagerEventHandler):
 
         self.send_text_message(telegram_message)
 
+    @handles('RemoteActionResult')
     def handle_remote_action_result(self, message: Dict):
         method_name = message['MethodName']
         if method_name == 'RemoteGetFilterConfiguration':
@@ -68,6 +79,7 @@ class GiantEventHandler(VoyagerEventHandler):
             for i in range(0, filter_count):
                 self.filter_name_list[i] = params[f'Filter{i + 1}_Name']
 
+    @handles('ShotRunning')
     def handle_shot_running(self, message: Dict):
         timestamp = message['Timestamp']
         main_shot_elapsed = message['Elapsed']
@@ -76,24 +88,19 @@ class GiantEventHandler(VoyagerEventHandler):
         status = message['Status']
         self.shot_running = status == 1  # 1 means running, all other things are 'not running'
 
-    def handle_control_data(self, message: Dict):
-        timestamp = message['Timestamp']
-        guide_status = message['GUIDESTAT']
-        dither_status = message['DITHSTAT']
-        is_tracking = message['MNTTRACK']
-        is_slewing = message['MNTSLEW']
-        guide_x = message['GUIDEX']
-        guide_y = message['GUIDEY']
-        running_seq = message['RUNSEQ']
-        running_dragscript = message['RUNDS']
+    @handles(CONTROL_DATA_CHANGED)
+    def handle_control_data_changed(self, message: Dict):
+        state = message['State']
+        self.guide_status = state['GUIDESTAT']
+        self.dither_status = state['DITHSTAT']
+        running_seq = state['RUNSEQ']
+        running_dragscript = state['RUNDS']
 
         self.curses_manager.update_job_status_info(
             JobStatusInfo(drag_script_name=running_dragscript, sequence_name=running_seq,
-                          guide_status=guide_status, dither_status=dither_status,
-                          is_tracking=is_tracking, is_slewing=is_slewing))
-
-        if self.shot_running and guide_status == GuideStatEnum.RUNNING and dither_status == DitherStatEnum.STOPPED:
-            self.add_guide_error_stat(guide_x, guide_y)
+                          guide_status=self.guide_status, dither_status=self.dither_status,
+                          is_tracking=state['MNTTRACK'], is_slewing=state['MNTSLEW']),
+            rig_label=self.rig_label)
 
         if running_dragscript != self.running_dragscript:
             self.sequence_map = {}
@@ -112,17 +119,23 @@ class GiantEventHandler(VoyagerEventHandler):
                 self.send_text_message(f'Just finished Sequence {self.running_seq}')
             elif self.running_seq == '':
                 self.send_text_message(f'Starting Sequence {running_seq}')
-                self.current_sequence_stat_chat_id = None
-                self.current_sequence_stat_message_id = None
+                self.reset_stats_message()
                 self.report_stats_for_current_sequence()
             else:
                 self.send_text_message(
                     f'Switching Sequence from {running_seq} to {self.running_seq}')
-                self.current_sequence_stat_chat_id = None
-                self.current_sequence_stat_message_id = None
+                self.reset_stats_message()
                 self.report_stats_for_current_sequence()
             self.running_seq = running_seq
 
+    @handles('ControlData')
+    def handle_control_data(self, message: Dict):
+        # Rig state is handled by 'handle_control_data_changed', every 'ControlData' still carries a guide sample.
+        if self.shot_running and self.guide_status == GuideStatEnum.RUNNING \
+                and self.dither_status == DitherStatEnum.STOPPED:
+            self.add_guide_error_stat(message['GUIDEX'], message['GUIDEY'])
+
+    @handles('AutoFocusResult')
     def handle_focus_result(self, message: Dict):
         is_empty = message['IsEmpty']
         if is_empty == "true":
@@ -151,7 +164,11 @@ class GiantEventHandler(VoyagerEventHandler):
         self.send_text_message(telegram_message)
 
     def current_sequence_stat(self) -> SequenceStat:
-        self.sequence_map.setdefault(self.running_seq, SequenceStat(name=self.running_seq))
+        if self.running_seq not in self.sequence_map:
+            stats_config = self.config.sequence_stats_config
+            self.sequence_map[self.running_seq] = SequenceStat(
+                name=self.running_seq, max_exposure_count=stats_config.hfd_plot_max_shots_count,
+                max_guide_sample_count=stats_config.guiding_error_plot['max_shots_count'])
         return self.sequence_map[self.running_seq]
 
     def add_exposure_stats(self, exposure: ExposureInfo, sequence_name: str):
@@ -163,6 +180,7 @@ class GiantEventHandler(VoyagerEventHandler):
     def add_focus_result(self, focus_result: FocusResult):
         self.current_sequence_stat().add_focus_result(focus_result)
 
+    @handles('NewJPGReady')
     def handle_jpg_ready(self, message: Dict):
         expo = message['Expo']
         filter_name = message['Filter']
@@ -176,7 +194,7 @@ class GiantEventHandler(VoyagerEventHandler):
                                 timestamp=timestamp)
         self.add_exposure_stats(exposure=exposure, sequence_name=sequence_target)
 
-        base64_photo = message['Base64Data']
+        photo = message['Base64Data']
 
         telegram_message = f'Exposure of {sequence_target} for {expo}sec using {filter_name} filter.' \
                            + f'HFD: {hfd}, StarIndex: {star_index}'
@@ -184,7 +202,10 @@ class GiantEventHandler(VoyagerEventHandler):
         if expo >= self.config.exposure_limit:
             fit_filename = message['File']
             new_filename = fit_filename[fit_filename.rindex('\\') + 1: fit_filename.index('.')] + '.jpg'
-            self.send_image_message(base64_photo, new_filename, telegram_message)
+            if self.preview_encoder is not None:
+                # Re-encoded on the upload thread, not here
+                photo = BudgetedImage(original=photo, encoder=self.preview_encoder)
+            self.send_image_message(photo, new_filename, telegram_message)
         else:
             self.send_text_message(telegram_message)
         # with PINNING and UNPINNING implemented, we can safely report stats for all images
@@ -194,37 +215,95 @@ class GiantEventHandler(VoyagerEventHandler):
         if self.current_sequence_stat().name == '':
             # one-off shots doesn't need stats, we only care about sequences.
             return
-        sequence_stat = self.current_sequence_stat()
-
-        base64_img = self.stat_plotter.plot(sequence_stat=sequence_stat)
-
-        if not self.current_sequence_stat_chat_id and not self.current_sequence_stat_message_id:
-            chat_id, message_id = self.send_image_message(base64_img=base64_img, image_fn='good_night_stats.jpg',
-                                                          msg_text=f'Statistics for {self.running_seq}',
-                                                          as_doc=False)
-            if chat_id and message_id:
-                self.current_sequence_stat_chat_id = chat_id
-                self.current_sequence_stat_message_id = message_id
-                status, info_dict = self.telegram_bot.unpin_all_messages(chat_id=chat_id)
-                if status == 'ERROR':
-                    print(
-                        f'\n[ERROR - {self.get_name()} - Unpin All Message]'
-                        f'[{info_dict["error_code"]}]'
-                        f'[{info_dict["description"]}]')
-
-                status, info_dict = self.telegram_bot.pin_message(chat_id=chat_id, message_id=message_id)
-                if status == 'ERROR':
-                    print(
-                        f'\n[ERROR - {self.get_name()} - Pin Message]'
-                        f'[{info_dict["error_code"]}]'
-                        f'[{info_dict["description"]}]')
-        else:
-            status, info_dict = self.telegram_bot.edit_image_message(chat_id=self.current_sequence_stat_chat_id,
-                                                                     message_id=self.current_sequence_stat_message_id,
-                                                                     base64_encoded_image=base64_img,
-                                                                     filename=self.running_seq + '_stat.jpg')
-            if status == 'ERROR':
-                print(
-                    f'\n[ERROR - {self.get_name()} - Edit Image Message]'
-                    f'[{info_dict["error_code"]}]'
-                    f'[{info_dict["description"]}]')
+        with self.stats_report_lock:
+            sequence_stat = self.current_sequence_stat()
+            stats_version = (sequence_stat.name, sequence_stat.version)
+            with self.stats_message_lock:
+                if stats_version == self.reported_stats_version:
+                    # e.g. a short sub, which doesn't count toward the stats
+                    return
+
+            # If rendering fails, the version is not recorded, and the next report tries again
+            image = self.stat_plotter.plot(sequence_stat=sequence_stat)
+            digest = hashlib.blake2b(image, digest_size=16).digest()
+            filename = self.running_seq + '_stat.jpg'
+
+            with self.stats_message_lock:
+                # Recorded before submitting, since callbacks of requests that already failed run right away,
+                # and clear it again
+                self.reported_stats_version = stats_version
+                try:
+                    if self.current_sequence_stat_message_ids:
+                        if digest != self.sent_stats_digest:
+                            self.edit_stats_message(self.current_sequence_stat_message_ids, image, filename, digest)
+                        # else stats changed in ways the plots don't show
+                    elif self.current_sequence_stat_future is not None:
+                        # Statistics message is still on its way, the latest image replaces it once it is there.
+                        self.pending_stats_image = (image, filename, digest)
+                    else:
+                        future = self.send_image_message(image=image, image_fn='good_night_stats.jpg',
+                                                         msg_text=f'Statistics for {self.running_seq}', as_doc=False)
+                        if future is None:
+                            self.reported_stats_version = None
+                            return
+                        self.current_sequence_stat_future = future
+                        future.add_done_callback(partial(self.pin_stats_message, digest))
+                except Exception:
+                    self.reported_stats_version = None
+                    raise
+
+    def reset_stats_message(self):
+        with self.stats_message_lock:
+            self.current_sequence_stat_message_ids = dict()
+            self.current_sequence_stat_future = None
+            self.pending_stats_image = None
+            self.reported_stats_version = None
+            self.sent_stats_digest = None
+
+    def edit_stats_message(self, message_ids: Dict[str, int], image, filename: str, digest: bytes):
+        future = self.telegram_bot.edit_image_messages(message_ids=message_ids, image=image, filename=filename)
+        future.add_done_callback(partial(self.report_telegram_error, 'Edit Image Message'))
+        future.add_done_callback(partial(self.record_stats_edit, message_ids, digest))
+
+    def record_stats_edit(self, message_ids: Dict[str, int], digest: bytes, future: Future):
+        """
+        Done callback of statistics message edits, remembers what the message shows once the edit went through.
+        """
+        status, _ = future.result()
+        with self.stats_message_lock:
+            if message_ids is not self.current_sequence_stat_message_ids:
+                return
+            if status == 'OK':
+                self.sent_stats_digest = digest
+            else:
+                # Telegram still shows older stats, the next report renders and edits again
+                self.reported_stats_version = None
+
+    def pin_stats_message(self, digest: bytes, future: Future):
+        """
+        Done callback of the statistics message of a sequence. Pins it in every chat that got it, so that later
+        reports can edit it in place, and sends the image of reports made while it was on its way.
+        """
+        status, info_dict = future.result()
+        with self.stats_message_lock:
+            if future is not self.current_sequence_stat_future:
+                # Sequence has changed since, this message is not the current one anymore
+                return
+            self.current_sequence_stat_future = None
+            pending_stats_image, self.pending_stats_image = self.pending_stats_image, None
+            # Even if some chats failed, the ones that got the message keep getting updates
+            message_ids = dict(info_dict.get('message_ids', dict()))
+            self.current_sequence_stat_message_ids = message_ids
+            if message_ids:
+                self.sent_stats_digest = digest
+            else:
+                # No chat got the statistics message, the next report sends it again
+                self.reported_stats_version = None
+
+        for chat_id, message_id in message_ids.items():
+            self.telegram_bot.unpin_all_messages(chat_id=chat_id).add_done_callback(
+                partial(self.report_telegram_error, 'Unpin All Message'))
+            self.telegram_bot.pin_message(chat_id=chat_id, message_id=message_id).add_done_callback(
+                partial(self.report_telegram_error, 'Pin Message'))
+        if pending_stats_image is not None and message_ids and pending_stats_image[2] != digest:
+            self.edit_stats_message(message_ids, *pending_stats_image)
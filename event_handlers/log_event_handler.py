@@ -1,32 +1,90 @@
+import threading
 from typing import Dict
 
 from curse_manager import CursesManager
 from data_structure.log_message_info import LogMessageInfo
-from event_handlers.voyager_event_handler import VoyagerEventHandler
-from telegram import TelegramBot
+from event_handlers.voyager_event_handler import VoyagerEventHandler, handles
+from outbound_telegram_scheduler import OutboundTelegramScheduler
+
+# dictionary of log level number to readable name.
+TYPE_DICT = {1: 'DEBUG', 2: 'INFO', 3: 'WARNING', 4: 'CRITICAL', 5: 'ACTION', 6: 'SUBTITLE', 7: 'EVENT',
+             8: 'REQUEST', 9: 'EMERGENCY'}
+TYPE_EMOJI_DICT = {1: '🐞', 2: 'ℹ️', 3: '⚠️', 4: '⛔️', 5: '🔧', 6: '📢', 7: '📰',
+                   8: '🈸', 9: '☢️'}
+# Telegram rejects text messages longer than this
+TELEGRAM_MAX_MESSAGE_LENGTH = 4096
 
 
 # This is just one of the event handlers which are interested in log events. You can write more
 class LogEventHandler(VoyagerEventHandler):
-    def __init__(self, config, telegram_bot: TelegramBot, curses_manager: CursesManager):
-        super().__init__(config=config, telegram_bot=telegram_bot, handler_name='LogEventHandler', curses_manager=curses_manager)
-
-    def interested_event_name(self):
-        return 'LogEvent'
+    """
+    Forwards allowed log lines to telegram as digests: lines arriving within 'log_digest.window_sec' of the first
+    one are sent as a single message, with repeated lines counted instead of repeated. Lines of the types in
+    'log_digest.flush_immediately_types' send the digest right away.
+    """
 
-    def handle_event(self, event_name: str, message: Dict):
-        # dictionary of log level number to readable name.
-        type_dict = {1: 'DEBUG', 2: 'INFO', 3: 'WARNING', 4: 'CRITICAL', 5: 'ACTION', 6: 'SUBTITLE', 7: 'EVENT',
-                     8: 'REQUEST', 9: 'EMERGENCY'}
-        type_emoji_dict = {1: '🐞', 2: 'ℹ️', 3: '⚠️', 4: '⛔️', 5: '🔧', 6: '📢', 7: '📰',
-                           8: '🈸', 9: '☢️'}
+    def __init__(self, config, telegram_bot: OutboundTelegramScheduler, curses_manager: CursesManager):
+        super().__init__(config=config, telegram_bot=telegram_bot, handler_name='LogEventHandler',
+                         curses_manager=curses_manager)
+        digest_config = self.config.log_digest
+        self.window_sec = digest_config.window_sec
+        self.flush_immediately_type_names = set(digest_config.flush_immediately_types)
+        self.max_message_length = min(digest_config.max_message_length, TELEGRAM_MAX_MESSAGE_LENGTH)
 
-        type_emoji = type_emoji_dict[message['Type']]
-        type_name = type_dict[message['Type']]
+        self.pending_lines = dict()  # (type number, text) => count, in the order lines first arrived
+        self.flush_timer = None
+        self.digest_lock = threading.Lock()  # digests are flushed by the timer thread too
 
-        telegram_message = f'{type_emoji}  <b><pre>{message["Text"]}</pre></b>'
+    @handles('LogEvent')
+    def handle_log_event(self, message: Dict):
+        type_name = TYPE_DICT[message['Type']]
         allowed_log_type_names = self.config.text_message_config.allowed_log_types
 
         if type_name in allowed_log_type_names:
-            self.curses_manager.append_log(LogMessageInfo(type=type_name, message=message['Text']))
-            self.send_text_message(telegram_message)
+            self.curses_manager.append_log(LogMessageInfo(type=type_name, message=self.with_rig_label(message['Text'])))
+            self.add_to_digest(message['Type'], message['Text'])
+            if type_name in self.flush_immediately_type_names or self.window_sec <= 0:
+                self.flush_digest()
+
+    def add_to_digest(self, log_type: int, text: str):
+        with self.digest_lock:
+            line_key = (log_type, text)
+            self.pending_lines[line_key] = self.pending_lines.get(line_key, 0) + 1
+            if self.flush_timer is None and self.window_sec > 0:
+                self.flush_timer = threading.Timer(self.window_sec, self.flush_digest)
+                self.flush_timer.daemon = True
+                self.flush_timer.start()
+
+    def flush(self):
+        self.flush_digest()
+
+    def flush_digest(self):
+        # Sent while holding 'digest_lock', so that a digest flushed by the timer thread and one flushed by the lane
+        # are queued to telegram in the order their lines arrived. Sending only queues the message, it's cheap.
+        with self.digest_lock:
+            if self.flush_timer is not None:
+                self.flush_timer.cancel()
+                self.flush_timer = None
+            pending_lines, self.pending_lines = self.pending_lines, dict()
+
+            telegram_message = ''
+            for (log_type, text), count in pending_lines.items():
+                line = self.format_line(log_type, text, count)
+                if telegram_message and len(telegram_message) + len(line) + 1 > self.max_message_length:
+                    self.send_text_message(telegram_message)
+                    telegram_message = ''
+                telegram_message = f'{telegram_message}\n{line}' if telegram_message else line
+
+            if telegram_message:
+                self.send_text_message(telegram_message)
+
+    def format_line(self, log_type: int, text: str, count: int = 1) -> str:
+        """
+        :return: A line of the digest, with the text cut short if the line wouldn't fit in a message by itself.
+        """
+        prefix = f'{TYPE_EMOJI_DICT[log_type]}  <b><pre>'
+        suffix = '</pre></b>' + (f' (x{count})' if count > 1 else '')
+        text_room = self.max_message_length - len(prefix) - len(suffix)
+        if len(text) > text_room:
+            text = text[:max(0, text_room - 1)] + '…'
+        return f'{prefix}{text}{suffix}'
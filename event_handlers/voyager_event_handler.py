@@ -1,98 +1,136 @@
-from abc import abstractmethod
-from typing import Dict, Tuple
+from concurrent.futures import Future
+from functools import partial
+from typing import Callable, Dict, List, Optional, Tuple
 
 from curse_manager import CursesManager
-from telegram import TelegramBot
+from outbound_telegram_scheduler import OutboundTelegramScheduler
+
+ALL_EVENTS = '*'
+
+
+def handles(*event_names: str):
+    """
+    Decorator that routes events to a handler method. The method receives the message dictionary only.
+    Routes are collected once, when the handler is registered to 'VoyagerClient'.
+    :param event_names: Names of the events this method processes
+    """
+
+    def decorator(method):
+        method.handled_event_names = getattr(method, 'handled_event_names', tuple()) + event_names
+        return method
+
+    return decorator
+
+
+def handles_all_events(method):
+    """
+    Decorator that routes every event to a handler method, after all handlers registered for that specific event.
+    """
+    return handles(ALL_EVENTS)(method)
 
 
 class VoyagerEventHandler:
     """
     A base class for all event handlers to inherit from.
 
-    To handle an incoming event from voyager application server, Most important method is the 'handle_event' method.
+    To handle an incoming event from voyager application server, decorate a method with '@handles(event names)'.
+    Note: a single message might be processed by multiple event handlers. Don't modify the message dict.
+    Telegram requests are queued by 'OutboundTelegramScheduler' and return futures, handlers never wait for them.
     """
 
     def __init__(self, config,
-                 telegram_bot: TelegramBot,
+                 telegram_bot: OutboundTelegramScheduler,
                  handler_name: str = 'DefaultHandler',
                  curses_manager: CursesManager = None):
         self.name = handler_name
         self.config = config
         self.telegram_bot = telegram_bot
         self.curses_manager = curses_manager
+        # Set when the bot monitors several rigs, so that messages tell which rig they are about
+        self.rig_label = getattr(config, 'rig_label', '')
 
-    def interested_event_names(self):
+    def routes(self) -> List[Tuple[str, Callable]]:
         """
-        :return: List of event names this event_handler wants to process.
+        :return: List of (event name, bound method) declared with '@handles', in the order methods are defined.
+        Event name is 'ALL_EVENTS' for methods declared with '@handles_all_events'.
         """
-        return []
+        methods = dict()
+        for klass in reversed(type(self).__mro__):
+            for attribute_name, attribute in vars(klass).items():
+                if hasattr(attribute, 'handled_event_names'):
+                    # pop first, so that an overriding method takes the place of the overridden one
+                    methods.pop(attribute_name, None)
+                    methods[attribute_name] = attribute
+
+        result = list()
+        for attribute_name, method in methods.items():
+            for event_name in method.handled_event_names:
+                result.append((event_name, getattr(self, attribute_name)))
+        return result
 
-    def interested_event_name(self):
+    def get_name(self):
         """
-        :return: An event name this event_handler wants to process.
+        :return: The name of this event_handler
         """
-        return None
+        return self.name
 
-    def interested_in_all_events(self):
+    def with_rig_label(self, message: str) -> str:
         """
-        :return: A boolean indicating whether this event handler wants to process all possible events.
+        :return: The message, prefixed with the rig label if there is one.
         """
-        return False
+        if not self.rig_label:
+            return message
+        return f'[{self.rig_label}] {message}'
 
-    def get_name(self):
+    def report_telegram_error(self, action: str, future: Future):
         """
-        :return: The name of this event_handler
+        Done callback of telegram requests, prints out the error message if the request failed.
+        :param action: What the request was about, e.g. 'Text Message'
+        :param future: Future of the (status, info_dict) tuple of the request
         """
-        return self.name
+        status, info_dict = future.result()
+        if status == 'ERROR':
+            print(
+                f'\n[ERROR - {self.get_name()} - {action}]'
+                f'[{info_dict["error_code"]}]'
+                f'[{info_dict["description"]}]')
 
-    def send_text_message(self, message: str):
+    def send_text_message(self, message: str) -> Optional[Future]:
         """
-        Send plain text message to Telegram, and print out error message
+        Queue plain text message to Telegram, and print out error message once it is sent
         :param message: The text that need to be sent to Telegram
+        :return: Future of the (status, info_dict) tuple of the request
         """
         if self.telegram_bot:
-            status, info_dict = self.telegram_bot.send_text_message(message)
-
-            if status == 'ERROR':
-                print(
-                    f'\n[ERROR - {self.get_name()} - Text Message]'
-                    f'[{info_dict["error_code"]}]'
-                    f'[{info_dict["description"]}]')
+            future = self.telegram_bot.send_text_message(self.with_rig_label(message))
+            future.add_done_callback(partial(self.report_telegram_error, 'Text Message'))
+            return future
         else:
             print(f'\n[ERROR - {self.get_name()} - Telegram Bot]')
 
-    def send_image_message(self, base64_img: bytes = None, image_fn: str = '', msg_text: str = '',
-                           as_doc: bool = True) -> Tuple[str or None, str or None]:
+        return None
+
+    def send_image_message(self, image=None, image_fn: str = '', msg_text: str = '',
+                           as_doc: bool = True) -> Optional[Future]:
         """
-        Send image message to Telegram, and print out error message
-        :param base64_img: image data that encoded as base64
+        Queue image message to Telegram, and print out error message once it is sent
+        :param image: raw image bytes, or an object producing them like 'LazyBase64Blob', see 'image_bytes'
         :param image_fn: the file name of the image
         :param msg_text: image capture in string format
         :param as_doc: if the image should be sent as document (for larger image file)
-        :return: Tuple of chat_id and message_id to check status
+        :return: Future of the (status, info_dict) tuple of the request, info_dict has chat_id and message_id
         """
         if self.telegram_bot:
-            status, info_dict = self.telegram_bot.send_image_message(base64_img, image_fn, msg_text, as_doc)
-
-            if status == 'ERROR':
-                print(
-                    f'\n[ERROR - {self.get_name()} - Text Message]'
-                    f'[{info_dict["error_code"]}]'
-                    f'[{info_dict["description"]}]')
-            elif status == 'OK':
-                return str(info_dict['chat_id']), str(info_dict['message_id'])
+            future = self.telegram_bot.send_image_message(image, image_fn, self.with_rig_label(msg_text), as_doc)
+            future.add_done_callback(partial(self.report_telegram_error, 'Image Message'))
+            return future
         else:
             print(f'\n[ERROR - {self.get_name()} - Telegram Bot]')
 
-        return None, None
+        return None
 
-    @abstractmethod
-    def handle_event(self, event_name: str, message: Dict):
+    def flush(self):
         """
-        Processes the incoming event + message. Note: a single message might be
-        processed by multiple event handlers. Don't modify the message dict.
-        :param event_name: The event name in string format.
-        :param message: A dictionary containing all messages
-        :return: Nothing
+        Send out whatever this handler still buffers. Called when the bot stops, does nothing by default.
         """
-        print('handling event', event_name, message)
+        pass
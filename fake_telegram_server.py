@@ -0,0 +1,424 @@
+#!/bin/env python3
+"""
+Local stand-in for the subset of the telegram bot API the bot uses, to load-test it on a machine with no internet.
+Responses are delayed, throttled and failed as configured in the 'fake_telegram_server' section of the config.
+Point the bot at it with 'telegram_http.api_base_url: http://<host>:<port>'. Statistics are printed every
+'report_interval_sec' seconds and on exit, and served as JSON on 'GET /stats'.
+Usage: python fake_telegram_server.py
+"""
+import email.parser
+import email.policy
+import math
+import random
+import re
+import threading
+import time
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, Tuple
+from urllib.parse import parse_qs
+
+import json_codec
+from configs import ConfigBuilder
+from token_bucket import TokenBucket
+
+# Request bodies are read, and throttled, this many bytes at a time
+CHUNK_SIZE = 16384
+
+
+class LatencyDistribution:
+    """
+    Random response latency with the given mean and standard deviation, in seconds.
+    'distribution' is one of constant, uniform, normal, exponential (stddev is the mean) or lognormal.
+    """
+
+    DISTRIBUTIONS = ('constant', 'uniform', 'normal', 'exponential', 'lognormal')
+
+    def __init__(self, distribution: str = 'constant', mean_sec: float = 0.0, stddev_sec: float = 0.0,
+                 rng: random.Random = None):
+        if distribution not in self.DISTRIBUTIONS:
+            raise ValueError(f'Unknown latency distribution {distribution}, valid values are {self.DISTRIBUTIONS}')
+        self.distribution = distribution
+        self.mean_sec = max(mean_sec, 0.0)
+        self.stddev_sec = max(stddev_sec, 0.0)
+        self.rng = rng or random.Random()
+
+    def sample(self) -> float:
+        if self.mean_sec == 0:
+            return 0.0
+        if self.distribution == 'uniform':
+            half_width = math.sqrt(3) * self.stddev_sec
+            return max(0.0, self.rng.uniform(self.mean_sec - half_width, self.mean_sec + half_width))
+        if self.distribution == 'normal':
+            return max(0.0, self.rng.gauss(self.mean_sec, self.stddev_sec))
+        if self.distribution == 'exponential':
+            return self.rng.expovariate(1 / self.mean_sec)
+        if self.distribution == 'lognormal':
+            # mu and sigma of the underlying normal distribution, from the mean and stddev of the lognormal one
+            sigma_squared = math.log(1 + (self.stddev_sec / self.mean_sec) ** 2)
+            return self.rng.lognormvariate(math.log(self.mean_sec) - sigma_squared / 2, math.sqrt(sigma_squared))
+        return self.mean_sec
+
+
+class FakeTelegramState:
+    """
+    Messages and uploaded files of the fake server, and statistics of the requests it served. Thread safe.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.next_message_ids = defaultdict(lambda: 1)  # chat id => id of the next message
+        self.message_ids = defaultdict(set)  # chat id => ids of messages sent to it
+        self.file_sizes = dict()  # file id => size in bytes
+        self.next_file_number = 1
+
+        self.started_time = time.monotonic()
+        self.request_counts = defaultdict(int)  # (method, outcome) => count
+        self.request_time_sums = defaultdict(float)  # method => seconds spent serving it, latency included
+        self.received_bytes = 0
+
+    def new_message(self, chat_id) -> int:
+        with self.lock:
+            message_id = self.next_message_ids[chat_id]
+            self.next_message_ids[chat_id] += 1
+            self.message_ids[chat_id].add(message_id)
+            return message_id
+
+    def has_message(self, chat_id, message_id) -> bool:
+        with self.lock:
+            return message_id in self.message_ids[chat_id]
+
+    def new_file(self, size: int) -> str:
+        with self.lock:
+            file_id = f'fake-file-{self.next_file_number}'
+            self.next_file_number += 1
+            self.file_sizes[file_id] = size
+            return file_id
+
+    def file_size(self, file_id: str):
+        with self.lock:
+            return self.file_sizes.get(file_id)
+
+    def record(self, method: str, outcome: str, elapsed_sec: float, received_bytes: int):
+        with self.lock:
+            self.request_counts[(method, outcome)] += 1
+            self.request_time_sums[method] += elapsed_sec
+            self.received_bytes += received_bytes
+
+    def stats(self) -> Dict[str, Any]:
+        with self.lock:
+            elapsed_sec = max(time.monotonic() - self.started_time, 1e-9)
+            methods = dict()
+            for (method, outcome), count in self.request_counts.items():
+                methods.setdefault(method, {'count': 0, 'outcomes': dict()})
+                methods[method]['count'] += count
+                methods[method]['outcomes'][outcome] = count
+            for method, method_stats in methods.items():
+                method_stats['avg_sec'] = self.request_time_sums[method] / method_stats['count']
+            request_count = sum(self.request_counts.values())
+            return {
+                'elapsed_sec': elapsed_sec,
+                'request_count': request_count,
+                'requests_per_sec': request_count / elapsed_sec,
+                'received_bytes': self.received_bytes,
+                'received_bytes_per_sec': self.received_bytes / elapsed_sec,
+                'methods': methods,
+            }
+
+
+class BotApiError(Exception):
+    """
+    Answered as a telegram error response, e.g. 'Bad Request: message to edit not found'.
+    """
+
+    def __init__(self, error_code: int, description: str, parameters: Dict[str, Any] = None):
+        super().__init__(description)
+        self.error_code = error_code
+        self.description = description
+        self.parameters = parameters
+
+
+class FakeTelegramRequestHandler(BaseHTTPRequestHandler):
+    # Keep-alive, like telegram, so that the connection pool of 'TelegramBot' is exercised too
+    protocol_version = 'HTTP/1.1'
+
+    server: 'FakeTelegramServer'
+
+    PATH_PATTERN = re.compile(r'^/bot[^/]+/(\w+)$')
+
+    def log_message(self, format, *args):
+        # The default logs every request to stderr
+        pass
+
+    def do_GET(self):
+        if self.path == '/stats':
+            self.send_json(200, self.server.state.stats())
+        else:
+            self.send_json(404, {'ok': False, 'error_code': 404, 'description': 'Not Found'})
+
+    def do_POST(self):
+        start_time = time.monotonic()
+        match = self.PATH_PATTERN.match(self.path)
+        method = match.group(1) if match else 'unknown'
+
+        body = self.read_body()
+        server = self.server
+        time.sleep(server.latency.sample())
+
+        # Failures are decided before the request is processed: telegram doesn't process requests it fails
+        roll = server.rng.random()
+        if roll < server.dropped_connection_rate:
+            # No response at all, the client sees the connection reset
+            self.close_connection = True
+            server.state.record(method, 'dropped', time.monotonic() - start_time, len(body))
+            return
+        roll -= server.dropped_connection_rate
+        if roll < server.too_many_requests_rate:
+            error = BotApiError(429, f'Too Many Requests: retry after {server.retry_after_sec}',
+                                {'retry_after': server.retry_after_sec})
+        elif roll - server.too_many_requests_rate < server.server_error_rate:
+            error = BotApiError(502, 'Bad Gateway')
+        elif method not in server.METHODS:
+            error = BotApiError(404, 'Not Found')
+        else:
+            error = None
+
+        if error is None:
+            try:
+                fields, files = self.parse_form(body)
+                result = getattr(self, server.METHODS[method])(fields, files)
+            except BotApiError as bot_api_error:
+                error = bot_api_error
+
+        if error is None:
+            self.send_json(200, {'ok': True, 'result': result})
+            outcome = 'ok'
+        else:
+            response = {'ok': False, 'error_code': error.error_code, 'description': error.description}
+            if error.parameters:
+                response['parameters'] = error.parameters
+            self.send_json(error.error_code, response)
+            outcome = str(error.error_code)
+        server.state.record(method, outcome, time.monotonic() - start_time, len(body))
+
+    def read_body(self) -> bytes:
+        """
+        Read the request body, no faster than 'bandwidth_bytes_per_sec' shared by every connection.
+        """
+        remaining = int(self.headers.get('Content-Length', 0))
+        chunks = list()
+        while remaining > 0:
+            if self.server.bandwidth_bucket is not None:
+                self.server.bandwidth_bucket.acquire()
+            chunk = self.rfile.read(min(CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            chunks.append(chunk)
+            remaining -= len(chunk)
+        return b''.join(chunks)
+
+    def parse_form(self, body: bytes) -> Tuple[Dict[str, str], Dict[str, bytes]]:
+        """
+        :return: Form fields, and uploaded files by field name, of an urlencoded or multipart body.
+        """
+        content_type = self.headers.get('Content-Type', '')
+        if not content_type.startswith('multipart/form-data'):
+            return {name: values[-1] for name, values in parse_qs(body.decode('utf-8')).items()}, dict()
+
+        fields, files = dict(), dict()
+        message = email.parser.BytesParser(policy=email.policy.HTTP).parsebytes(
+            b'Content-Type: ' + content_type.encode('latin-1') + b'\r\n\r\n' + body)
+        for part in message.iter_parts():
+            name = part.get_param('name', header='content-disposition')
+            payload = part.get_payload(decode=True)
+            if part.get_filename() is None:
+                fields[name] = payload.decode('utf-8')
+            else:
+                files[name] = payload
+        return fields, files
+
+    def send_json(self, status_code: int, response: Dict[str, Any]):
+        content = json_codec.dumps(response).encode('utf-8')
+        self.send_response(status_code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    @staticmethod
+    def chat_id(fields: Dict[str, str]):
+        if not fields.get('chat_id'):
+            raise BotApiError(400, 'Bad Request: chat_id is empty')
+        chat_id = fields['chat_id']
+        # Telegram answers chat ids as numbers, '@channel_name' ids stay strings
+        return int(chat_id) if chat_id.lstrip('-').isdigit() else chat_id
+
+    def message_id(self, fields: Dict[str, str], chat_id, description: str) -> int:
+        message_id = fields.get('message_id', '')
+        if not message_id.isdigit() or not self.server.state.has_message(chat_id, int(message_id)):
+            raise BotApiError(400, f'Bad Request: {description}')
+        return int(message_id)
+
+    def media(self, field_value: str, files: Dict[str, bytes], field_name: str) -> Dict[str, Any]:
+        """
+        :return: Telegram's description of an uploaded file, or of the one a file_id refers to.
+        """
+        if field_name in files:
+            content = files[field_name]
+            return {'file_id': self.server.state.new_file(len(content)), 'file_size': len(content)}
+        file_size = self.server.state.file_size(field_value)
+        if file_size is None:
+            raise BotApiError(400, 'Bad Request: wrong file identifier/HTTP URL specified')
+        return {'file_id': field_value, 'file_size': file_size}
+
+    def message(self, chat_id, message_id: int = None, **content) -> Dict[str, Any]:
+        if message_id is None:
+            message_id = self.server.state.new_message(chat_id)
+        return {'message_id': message_id, 'date': int(time.time()), 'chat': {'id': chat_id, 'type': 'private'},
+                **content}
+
+    def send_message(self, fields: Dict[str, str], files: Dict[str, bytes]):
+        chat_id = self.chat_id(fields)
+        if not fields.get('text'):
+            raise BotApiError(400, 'Bad Request: message text is empty')
+        return self.message(chat_id, text=fields['text'])
+
+    def send_photo(self, fields: Dict[str, str], files: Dict[str, bytes]):
+        chat_id = self.chat_id(fields)
+        photo = self.media(fields.get('photo', ''), files, 'photo')
+        return self.message(chat_id, photo=[photo], caption=fields.get('caption', ''))
+
+    def send_document(self, fields: Dict[str, str], files: Dict[str, bytes]):
+        chat_id = self.chat_id(fields)
+        document = self.media(fields.get('document', ''), files, 'document')
+        return self.message(chat_id, document=document, caption=fields.get('caption', ''))
+
+    def edit_message_media(self, fields: Dict[str, str], files: Dict[str, bytes]):
+        chat_id = self.chat_id(fields)
+        message_id = self.message_id(fields, chat_id, 'message to edit not found')
+        try:
+            media = json_codec.loads(fields.get('media', ''))
+        except ValueError:
+            raise BotApiError(400, 'Bad Request: can\'t parse input media JSON object')
+        media_value = media.get('media', '')
+        if media_value.startswith('attach://'):
+            photo = self.media('', files, media_value[len('attach://'):])
+        else:
+            photo = self.media(media_value, files, '')
+        return self.message(chat_id, message_id=message_id, photo=[photo])
+
+    def pin_chat_message(self, fields: Dict[str, str], files: Dict[str, bytes]):
+        self.message_id(fields, self.chat_id(fields), 'message to pin not found')
+        return True
+
+    def unpin_chat_message(self, fields: Dict[str, str], files: Dict[str, bytes]):
+        self.message_id(fields, self.chat_id(fields), 'message to unpin not found')
+        return True
+
+    def unpin_all_chat_messages(self, fields: Dict[str, str], files: Dict[str, bytes]):
+        self.chat_id(fields)
+        return True
+
+
+class FakeTelegramServer(ThreadingHTTPServer):
+    """
+    The fake telegram server, every request is served on its own thread.
+    Error rates are the chances of a request failing that way, they add up to the chance of any failure.
+    """
+
+    daemon_threads = True
+
+    # Bot API method => name of the 'FakeTelegramRequestHandler' method implementing it
+    METHODS = {
+        'sendMessage': 'send_message',
+        'sendPhoto': 'send_photo',
+        'sendDocument': 'send_document',
+        'editMessageMedia': 'edit_message_media',
+        'pinChatMessage': 'pin_chat_message',
+        'unpinChatMessage': 'unpin_chat_message',
+        'unpinAllChatMessages': 'unpin_all_chat_messages',
+    }
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 8081, latency: LatencyDistribution = None,
+                 bandwidth_bytes_per_sec: int = 0, too_many_requests_rate: float = 0.0, retry_after_sec: int = 1,
+                 server_error_rate: float = 0.0, dropped_connection_rate: float = 0.0, seed: int = None):
+        super().__init__((host, port), FakeTelegramRequestHandler)
+        self.rng = random.Random(seed)
+        self.latency = latency or LatencyDistribution()
+        self.latency.rng = self.rng
+        # One token per chunk, a chunk worth of burst
+        self.bandwidth_bucket = TokenBucket(rate_per_sec=bandwidth_bytes_per_sec / CHUNK_SIZE) \
+            if bandwidth_bytes_per_sec > 0 else None
+        self.too_many_requests_rate = too_many_requests_rate
+        self.retry_after_sec = retry_after_sec
+        self.server_error_rate = server_error_rate
+        self.dropped_connection_rate = dropped_connection_rate
+        self.state = FakeTelegramState()
+
+        self.serve_thread = None
+
+    @classmethod
+    def from_config(cls, config) -> 'FakeTelegramServer':
+        server_config = config.fake_telegram_server
+        latency_config = server_config.latency
+        error_rates = server_config.error_rates
+        return cls(host=server_config.host, port=server_config.port,
+                   latency=LatencyDistribution(distribution=latency_config['distribution'],
+                                               mean_sec=latency_config['mean_sec'],
+                                               stddev_sec=latency_config['stddev_sec']),
+                   bandwidth_bytes_per_sec=server_config.bandwidth_bytes_per_sec,
+                   too_many_requests_rate=error_rates['too_many_requests'],
+                   retry_after_sec=server_config.retry_after_sec,
+                   server_error_rate=error_rates['server_error'],
+                   dropped_connection_rate=error_rates['dropped_connection'],
+                   seed=server_config.seed)
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def start(self):
+        """
+        Serve on a background thread, e.g. to run it in the same process as the bot in a load test.
+        """
+        self.serve_thread = threading.Thread(target=self.serve_forever, name='FakeTelegramServer', daemon=True)
+        self.serve_thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        if self.serve_thread is not None:
+            self.serve_thread.join()
+
+
+def print_stats(stats: Dict[str, Any]):
+    print(f'\n=== {stats["elapsed_sec"]:.0f}s, {stats["request_count"]} requests '
+          f'({stats["requests_per_sec"]:.2f}/s), {stats["received_bytes"] / 1048576:.2f} MB received '
+          f'({stats["received_bytes_per_sec"] / 1024:.1f} KB/s) ===')
+    print(f'{"Method":24} {"Count":>8} {"Avg(s)":>8}  Outcomes')
+    for method, method_stats in sorted(stats['methods'].items()):
+        outcomes = ', '.join(f'{outcome}: {count}' for outcome, count in sorted(method_stats['outcomes'].items()))
+        print(f'{method:24} {method_stats["count"]:8} {method_stats["avg_sec"]:8.3f}  {outcomes}')
+
+
+def main():
+    config = ConfigBuilder().build()
+    server = FakeTelegramServer.from_config(config)
+    server.start()
+    print(f'Fake telegram server listening on {server.base_url}')
+
+    report_interval_sec = config.fake_telegram_server.report_interval_sec
+    try:
+        while True:
+            time.sleep(report_interval_sec)
+            print_stats(server.state.stats())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.stop()
+        print_stats(server.state.stats())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,53 @@
+#!/bin/env python3
+import numpy as np
+
+
+class GrowableArray:
+    """
+    Append-only typed NumPy buffer, doubling its capacity when full, so appends are amortized O(1) and values take
+    'dtype' bytes each instead of a Python object each. 'view' exposes the values without copying them.
+
+    With a positive 'max_size' it's a ring buffer keeping the latest 'max_size' values: the buffer is twice that
+    large, and the latest values are moved back to its front once the end is reached, so views stay contiguous.
+    """
+
+    def __init__(self, dtype=np.float64, initial_capacity: int = 256, max_size: int = -1):
+        self.max_size = max_size if max_size > 0 else -1
+        capacity = 2 * self.max_size if self.max_size > 0 else max(1, initial_capacity)
+        self.buffer = np.empty(capacity, dtype=dtype)
+        self.start = 0
+        self.end = 0
+        self.dropped_count = 0  # number of values dropped off the front to stay within 'max_size'
+
+    def append(self, value):
+        if self.end == len(self.buffer):
+            if self.max_size > 0:
+                # Keep the latest values but one, making room for this one
+                kept_count = self.max_size - 1
+                self.buffer[:kept_count] = self.buffer[self.end - kept_count:self.end]
+                self.start, self.end = 0, kept_count
+                self.dropped_count += 1
+            else:
+                grown_buffer = np.empty(len(self.buffer) * 2, dtype=self.buffer.dtype)
+                grown_buffer[:self.end] = self.buffer[:self.end]
+                self.buffer = grown_buffer
+        self.buffer[self.end] = value
+        self.end += 1
+        if self.max_size > 0 and self.end - self.start > self.max_size:
+            self.start += 1
+            self.dropped_count += 1
+
+    def view(self) -> np.ndarray:
+        """
+        :return: The values kept, oldest first, sharing memory with the buffer. Don't keep it around across appends.
+        """
+        return self.buffer[self.start:self.end]
+
+    def appended_count(self) -> int:
+        """
+        :return: Number of values ever appended, dropped ones included.
+        """
+        return self.dropped_count + len(self)
+
+    def __len__(self):
+        return self.end - self.start
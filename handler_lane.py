@@ -0,0 +1,55 @@
+#!/bin/env python3
+from typing import Callable, Iterable
+
+from bounded_queue import BoundedQueue, OverflowPolicy, QueueWorker
+
+
+class HandlerLane:
+    """
+    A private FIFO lane of a single event handler: its own bounded queue, drained by its own worker thread.
+    Routes of one handler still run one at a time and in arrival order, but a handler that is busy
+    (e.g. rendering a big statistics figure) only delays itself, never the other handlers.
+    """
+
+    def __init__(self, handler_name: str, run_route: Callable, max_size: int = 200,
+                 overflow_policy: str = OverflowPolicy.DROP_OLDEST, undroppable_event_names: Iterable[str] = ()):
+        """
+        :param handler_name: Name of the handler, used to name the queue and the thread
+        :param run_route: Called on the lane thread with (event name, route, message) of every queued item
+        :param undroppable_event_names: Events that are still queued when the lane is full, other events are
+        dropped instead
+        """
+        self.handler_name = handler_name
+        self.run_route = run_route
+        self.undroppable_event_names = frozenset(undroppable_event_names)
+        self.queue = BoundedQueue(max_size=max_size, overflow_policy=overflow_policy, name=f'{handler_name}Lane',
+                                  is_undroppable=self.is_undroppable if self.undroppable_event_names else None)
+        self.worker = QueueWorker(queue=self.queue, target=self.process_item, name=f'{handler_name}LaneWorker')
+
+    def put(self, event_name: str, route: Callable, message) -> bool:
+        return self.queue.put((event_name, route, message))
+
+    def is_undroppable(self, item) -> bool:
+        return item[0] in self.undroppable_event_names
+
+    def process_item(self, item):
+        self.run_route(*item)
+
+    def backlog(self) -> int:
+        return self.queue.backlog()
+
+    def dropped_count(self) -> int:
+        return self.queue.dropped_count
+
+    def start(self):
+        if not self.worker.is_alive():
+            self.worker.start()
+
+    def wait_until_idle(self, timeout: float = None) -> bool:
+        """
+        :return: True once everything queued so far was handled, False if it timed out.
+        """
+        return self.queue.join(timeout)
+
+    def stop(self):
+        self.worker.stop()
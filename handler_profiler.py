@@ -0,0 +1,196 @@
+#!/bin/env python3
+import cProfile
+import functools
+import io
+import os
+import pstats
+import signal
+import threading
+import time
+from datetime import datetime
+from typing import Callable, Iterable
+
+
+class HandlerProfiler:
+    """
+    On-demand profiling of event handler routes, the render path and telegram calls.
+
+    Nothing is wrapped while no profiling window is open: 'start_window' swaps in wrapped routes and methods,
+    'stop_window' puts the originals back and writes a report. So it costs nothing when disabled, and can stay
+    in production builds. A window can be opened with SIGUSR1 (Ctrl+Break on Windows) while the bot is running.
+    """
+
+    def __init__(self, output_dir: str = 'profiles', window_sec: float = 60, top_frames: int = 20):
+        self.output_dir = output_dir
+        self.window_sec = window_sec
+        self.top_frames = top_frames
+
+        self.voyager_clients = list()
+        self.instrumented_methods = list()  # list of (label, object, method names)
+
+        self.window_lock = threading.Lock()
+        self.window_timer = None
+        self.window_start_time = None
+
+        self.label_stats = dict()  # label => [number of calls, cumulative seconds]
+        # (label, thread id) => cProfile.Profile of the outermost calls with this label on that thread.
+        # A profile can only be enabled on one thread at a time, so every thread gets its own, merged in the report.
+        self.label_profiles = dict()
+        self.stats_lock = threading.Lock()
+        self.thread_state = threading.local()  # whether a profiled call is already running on a thread
+
+        self.route_wrappers = dict()  # route => wrapped route, reused by every window
+
+    def register_voyager_client(self, voyager_client):
+        self.voyager_clients.append(voyager_client)
+
+    def register_methods(self, label: str, obj, method_names: Iterable[str]):
+        self.instrumented_methods.append((label, obj, list(method_names)))
+
+    def install_signal_handler(self):
+        signal_number = getattr(signal, 'SIGUSR1', None) or getattr(signal, 'SIGBREAK', None)
+        if signal_number is None:
+            return
+        try:
+            signal.signal(signal_number, lambda signum, frame: self.start_window())
+        except ValueError:
+            # Only the main thread can install signal handlers
+            print('[Profiler] Signal handler not installed, profiling windows can only be started from code.')
+
+    def is_active(self) -> bool:
+        return self.window_start_time is not None
+
+    def start_window(self, window_sec: float = None):
+        with self.window_lock:
+            if self.is_active():
+                return
+
+            self.label_stats = dict()
+            self.label_profiles = dict()
+            self.window_start_time = time.time()
+
+            for voyager_client in self.voyager_clients:
+                voyager_client.instrument_routes(self.wrap_route)
+            for label, obj, method_names in self.instrumented_methods:
+                for method_name in method_names:
+                    method = getattr(obj, method_name)
+                    setattr(obj, method_name, self.wrap(f'{label}.{method_name}', method))
+
+            self.window_timer = threading.Timer(window_sec or self.window_sec, self.stop_window)
+            self.window_timer.daemon = True
+            self.window_timer.start()
+        print(f'\n[Profiler] Profiling for {window_sec or self.window_sec} sec')
+
+    def stop_window(self):
+        with self.window_lock:
+            if not self.is_active():
+                return
+
+            for voyager_client in self.voyager_clients:
+                voyager_client.instrument_routes(None)
+            for label, obj, method_names in self.instrumented_methods:
+                for method_name in method_names:
+                    # Drops the instance attribute, so the class method shows up again
+                    delattr(obj, method_name)
+
+            if self.window_timer is not None:
+                self.window_timer.cancel()
+                self.window_timer = None
+
+            report_path = self.write_report()
+            self.window_start_time = None
+        print(f'\n[Profiler] Profiling report written to {report_path}')
+
+    def wrap_route(self, route: Callable) -> Callable:
+        if route not in self.route_wrappers:
+            wrapped_route = self.wrap(f'{route.__self__.get_name()}.{route.__name__}', route)
+            wrapped_route.__self__ = route.__self__
+            self.route_wrappers[route] = wrapped_route
+        return self.route_wrappers[route]
+
+    def wrap(self, label: str, function: Callable) -> Callable:
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            return self.profile_call(label, function, *args, **kwargs)
+
+        return wrapper
+
+    def profile_call(self, label: str, function: Callable, *args, **kwargs):
+        profile = None
+        if not getattr(self.thread_state, 'profiling', False):
+            # Only the outermost call of a thread gets a cProfile, nested labels are timed only.
+            with self.stats_lock:
+                profile_key = (label, threading.get_ident())
+                profile = self.label_profiles.get(profile_key)
+                if profile is None:
+                    profile = self.label_profiles[profile_key] = cProfile.Profile()
+            try:
+                profile.enable()
+                self.thread_state.profiling = True
+            except ValueError:
+                # Another profiler is active, e.g. the same label on another thread with a per-process profiler
+                profile = None
+
+        start_time = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            elapsed_sec = time.perf_counter() - start_time
+            if profile is not None:
+                profile.disable()
+                self.thread_state.profiling = False
+            with self.stats_lock:
+                label_stat = self.label_stats.setdefault(label, [0, 0.0])
+                label_stat[0] += 1
+                label_stat[1] += elapsed_sec
+
+    def write_report(self) -> str:
+        os.makedirs(self.output_dir, exist_ok=True)
+        report_path = os.path.join(self.output_dir,
+                                   datetime.now().strftime('profile_%Y_%m_%d_%H_%M_%S.txt'))
+        window_sec = time.time() - self.window_start_time
+
+        with self.stats_lock, open(report_path, 'w') as report_file:
+            report_file.write(f'Profiling window: {window_sec:.1f} sec\n\n')
+            report_file.write(f'{"Label":60} {"Calls":>8} {"Cumulative(s)":>14} {"Avg(ms)":>10}\n')
+            sorted_labels = sorted(self.label_stats.items(), key=lambda item: -item[1][1])
+            for label, (calls, total_sec) in sorted_labels:
+                report_file.write(f'{label:60} {calls:8} {total_sec:14.3f} {total_sec * 1000 / calls:10.2f}\n')
+
+            profiles_by_label = dict()
+            for (label, _), profile in self.label_profiles.items():
+                profiles_by_label.setdefault(label, list()).append(profile)
+
+            for label, _ in sorted_labels:
+                stream = io.StringIO()
+                label_stats = None
+                merged_count = 0
+                for profile in profiles_by_label.get(label, list()):
+                    try:
+                        if label_stats is None:
+                            label_stats = pstats.Stats(profile, stream=stream)
+                        else:
+                            label_stats.add(profile)
+                        merged_count += 1
+                    except TypeError:
+                        # Nothing was recorded by this profile
+                        continue
+                if label_stats is None:
+                    continue
+                label_stats.sort_stats('cumulative').print_stats(self.top_frames)
+                report_file.write(f'\n===== {label} (merged from {merged_count} threads) =====\n')
+                report_file.write(stream.getvalue())
+
+            # Collected for every route all the time, not just during this window
+            for voyager_client in self.voyager_clients:
+                rig_label = getattr(voyager_client.config, 'rig_label', '')
+                title = f'Dispatch since start [{rig_label}]' if rig_label else 'Dispatch since start'
+                report_file.write(f'\n===== {title} =====\n')
+                report_file.write(f'{"Route":60} {"Calls":>8} {"Cumulative(s)":>14} {"Avg(ms)":>10}\n')
+                route_stats = sorted(voyager_client.route_stat_report().items(), key=lambda item: -item[1][1])
+                for route_name, (calls, total_sec) in route_stats:
+                    if calls:
+                        report_file.write(f'{route_name:60} {calls:8} {total_sec:14.3f} '
+                                          f'{total_sec * 1000 / calls:10.2f}\n')
+
+        return report_path
@@ -0,0 +1,52 @@
+#!/bin/env python3
+import time
+from collections import deque
+from typing import Tuple
+
+
+class HeartbeatMonitor:
+    """
+    Liveness check for the voyager socket. A half-open TCP connection doesn't fail any 'send', it just goes quiet,
+    so the link is declared dead once nothing was received for 'max_missed_intervals' keep-alive intervals.
+    RTT of each heartbeat is measured from our 'Polling' frame to the first 'Polling' frame voyager sends back.
+    """
+
+    def __init__(self, interval_sec: float = 5, max_missed_intervals: int = 3, rtt_history_size: int = 100):
+        self.interval_sec = interval_sec
+        self.max_missed_intervals = max_missed_intervals
+
+        self.last_received_timestamp = time.monotonic()
+        self.polling_sent_timestamp = None  # When the oldest unanswered 'Polling' was sent
+        self.rtt_history = deque(maxlen=rtt_history_size)  # RTT of recent heartbeats, in seconds
+
+    def reset(self):
+        """Called for every new connection."""
+        self.last_received_timestamp = time.monotonic()
+        self.polling_sent_timestamp = None
+
+    def on_polling_sent(self):
+        if self.polling_sent_timestamp is None:
+            self.polling_sent_timestamp = time.monotonic()
+
+    def on_frame_received(self, event_name: str = None):
+        now = time.monotonic()
+        self.last_received_timestamp = now
+        if event_name == 'Polling' and self.polling_sent_timestamp is not None:
+            self.rtt_history.append(now - self.polling_sent_timestamp)
+            self.polling_sent_timestamp = None
+
+    def missed_intervals(self) -> int:
+        return int((time.monotonic() - self.last_received_timestamp) // self.interval_sec)
+
+    def is_dead(self) -> bool:
+        return self.missed_intervals() >= self.max_missed_intervals
+
+    def rtt_stats(self) -> Tuple[float, float, float]:
+        """
+        :return: Tuple of last, average and max RTT of recent heartbeats in seconds, all zeros if nothing measured.
+        """
+        # Also read by the curses screen from other threads, so work on a copy the event loop can't append to
+        rtt_history = list(self.rtt_history)
+        if not rtt_history:
+            return 0.0, 0.0, 0.0
+        return rtt_history[-1], sum(rtt_history) / len(rtt_history), max(rtt_history)
@@ -0,0 +1,68 @@
+#!/bin/env python3
+"""
+The one place JSON is encoded and decoded. Standard library 'json' is the default backend, a faster one is picked
+at runtime when installed. Always call through the module ('json_codec.loads'), so that 'use_backend' takes effect.
+"""
+import json
+
+BACKEND_NAMES = ('orjson', 'ujson', 'json')
+
+
+def _json_backend():
+    return json.loads, lambda obj: json.dumps(obj)
+
+
+def _orjson_backend():
+    import orjson
+    return orjson.loads, lambda obj: orjson.dumps(obj).decode('utf-8')
+
+
+def _ujson_backend():
+    import ujson
+    return ujson.loads, lambda obj: ujson.dumps(obj, ensure_ascii=False)
+
+
+_BACKEND_FACTORIES = {
+    'orjson': _orjson_backend,
+    'ujson': _ujson_backend,
+    'json': _json_backend,
+}
+
+backend_name = 'json'
+loads, dumps = _json_backend()
+
+
+def available_backend_names():
+    """
+    :return: Names of the backends that can be imported here, fastest first.
+    """
+    result = list()
+    for name in BACKEND_NAMES:
+        try:
+            _BACKEND_FACTORIES[name]()
+            result.append(name)
+        except ImportError:
+            pass
+    return result
+
+
+def use_backend(name: str = 'auto') -> str:
+    """
+    Switch the backend used by 'loads' and 'dumps'.
+    :param name: One of 'orjson', 'ujson', 'json', or 'auto' for the fastest one installed.
+    :return: Name of the backend actually in use, falls back to 'json' if the requested one isn't installed.
+    """
+    global backend_name, loads, dumps
+
+    if name == 'auto':
+        name = available_backend_names()[0]
+
+    try:
+        loads, dumps = _BACKEND_FACTORIES[name]()
+        backend_name = name
+    except (KeyError, ImportError):
+        print(f'JSON backend "{name}" is not available, falling back to json.')
+        loads, dumps = _json_backend()
+        backend_name = 'json'
+
+    return backend_name
@@ -0,0 +1,78 @@
+#!/bin/env python3
+"""
+Micro-benchmark of JSON backends over recorded voyager traffic, i.e. a log file written with 'should_dump_log'.
+Usage: python json_codec_benchmark.py <log file> [repeat]
+"""
+import sys
+import time
+from collections import defaultdict
+
+import json_codec
+from event_filter import EventFilter
+
+
+def load_recorded_messages(log_fn: str):
+    """
+    :return: Dictionary of event name => list of raw messages. Command replies are grouped as 'jsonrpc'.
+    """
+    messages_by_event = defaultdict(list)
+    with open(log_fn, 'r') as log_f:
+        for line in log_f:
+            message_string = line.strip()
+            if not message_string:
+                continue
+            messages_by_event[EventFilter.event_name(message_string) or 'jsonrpc'].append(message_string)
+    return messages_by_event
+
+
+def benchmark_backend(messages_by_event: dict, repeat: int = 5):
+    """
+    :return: Dictionary of event name => (decode cost, encode cost) per message, in microseconds.
+    """
+    result = dict()
+    for event_name, messages in messages_by_event.items():
+        decoded_messages = [json_codec.loads(message) for message in messages]
+
+        start = time.perf_counter()
+        for _ in range(repeat):
+            for message in messages:
+                json_codec.loads(message)
+        decode_us = (time.perf_counter() - start) * 1e6 / (repeat * len(messages))
+
+        start = time.perf_counter()
+        for _ in range(repeat):
+            for message in decoded_messages:
+                json_codec.dumps(message)
+        encode_us = (time.perf_counter() - start) * 1e6 / (repeat * len(messages))
+
+        result[event_name] = (decode_us, encode_us)
+    return result
+
+
+def main(log_fn: str, repeat: int = 5):
+    messages_by_event = load_recorded_messages(log_fn)
+    event_names = sorted(messages_by_event.keys(), key=lambda name: -len(messages_by_event[name]))
+
+    for backend_name in json_codec.available_backend_names():
+        json_codec.use_backend(backend_name)
+        result = benchmark_backend(messages_by_event, repeat=repeat)
+
+        print(f'\n=== {backend_name} ===')
+        print(f'{"Event":24} {"Count":>8} {"Avg size":>10} {"Decode(us)":>12} {"Encode(us)":>12} {"Total(ms)":>10}')
+        total_ms = 0.0
+        for event_name in event_names:
+            messages = messages_by_event[event_name]
+            decode_us, encode_us = result[event_name]
+            event_total_ms = decode_us * len(messages) / 1000
+            total_ms += event_total_ms
+            avg_size = sum(len(message) for message in messages) / len(messages)
+            print(f'{event_name:24} {len(messages):8} {avg_size:10.0f} {decode_us:12.2f} {encode_us:12.2f} '
+                  f'{event_total_ms:10.2f}')
+        print(f'Decoding the whole log once costs {total_ms:.2f} ms')
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print(__doc__)
+        sys.exit(1)
+    main(sys.argv[1], int(sys.argv[2]) if len(sys.argv) > 2 else 5)
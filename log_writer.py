@@ -7,8 +7,9 @@ import os
 
 
 class LogWriter:
-    def __init__(self, config):
+    def __init__(self, config, log_name: str = ''):
         self.config = config
+        self.log_name = log_name  # Tells log files of different rigs apart, empty if there's only one rig
         self._log_file = None
         self.should_dump_log = self.config.should_dump_log
 
@@ -20,9 +21,16 @@ class LogWriter:
         return datetime.fromtimestamp(timestamp, tz=timezone)
 
     def write_line(self, message):
+        """
+        Writes a received message as a single line. Messages can be multi-megabyte previews,
+        so they are written as-is instead of being stripped and concatenated into another copy.
+        """
         if not self.should_dump_log:
             return
-        self.current_log_file().write(message.strip() + '\n')
+        log_file = self.current_log_file()
+        log_file.write(message)
+        if not message.endswith('\n'):
+            log_file.write('\n')
 
     def maybe_flush(self):
         if self._log_file and not self._log_file.closed:
@@ -57,5 +65,5 @@ class LogWriter:
         now = datetime.now()
         date_str = now.strftime('%Y_%m_%d_')
         self.close()
-        self._log_file = open(date_str + '_voyager_bot_log.txt', 'a')
+        self._log_file = open(date_str + self.log_name + '_voyager_bot_log.txt', 'a')
         return self._log_file
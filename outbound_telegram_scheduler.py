@@ -0,0 +1,238 @@
+#!/bin/env python3
+import threading
+import time
+from concurrent.futures import Future
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from bounded_queue import BoundedQueue, OverflowPolicy, QueueWorker
+from data_structure.outbound_request import OutboundRequest
+from token_bucket import TokenBucket
+
+
+class OutboundTelegramScheduler:
+    """
+    Sits between event handlers and 'TelegramBot' (or 'HTMLTelegramBot'), and has the same methods.
+    Instead of doing the request, every method queues it and returns a 'concurrent.futures.Future' of the usual
+    (status, info_dict) tuple, so handler threads never wait for the network.
+
+    Messages go to every chat of the bot at the same time, images are uploaded to the first chat only and shared with
+    the other ones by their telegram 'file_id'. Results of all chats are merged into one, see 'merge_results'.
+
+    Every chat has its own FIFO lane, so messages arrive in the order they were sent. Lanes respect a global and a
+    per chat token bucket, wait as long as telegram asks for when it answers 429 with 'retry_after' (up to
+    'max_rate_limited_wait_sec' per request), and retry network errors and 5xx answers with exponential backoff.
+    """
+
+    def __init__(self, telegram_bot, global_messages_per_sec: float = 30, chat_messages_per_sec: float = 1,
+                 chat_burst: int = 3, max_retries: int = 3, retry_delay_sec: float = 1, queue_size: int = 500,
+                 max_rate_limited_wait_sec: float = 300):
+        self.telegram_bot = telegram_bot
+        self.chat_ids = [str(chat_id) for chat_id in getattr(telegram_bot, 'chat_ids', [''])]
+
+        self.global_bucket = TokenBucket(rate_per_sec=global_messages_per_sec, burst=int(global_messages_per_sec))
+        self.chat_messages_per_sec = chat_messages_per_sec
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self.retry_delay_sec = retry_delay_sec
+        self.max_rate_limited_wait_sec = max_rate_limited_wait_sec
+        self.queue_size = queue_size
+
+        self.chat_lanes = dict()  # chat id => (queue, worker, token bucket)
+        self.lanes_lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config, telegram_bot) -> 'OutboundTelegramScheduler':
+        rate_limit_config = config.telegram_rate_limit
+        return cls(telegram_bot=telegram_bot,
+                   global_messages_per_sec=rate_limit_config.global_messages_per_sec,
+                   chat_messages_per_sec=rate_limit_config.chat_messages_per_sec,
+                   chat_burst=rate_limit_config.chat_burst,
+                   max_retries=rate_limit_config.max_retries,
+                   retry_delay_sec=rate_limit_config.retry_delay_sec,
+                   queue_size=rate_limit_config.queue_size,
+                   max_rate_limited_wait_sec=rate_limit_config.max_rate_limited_wait_sec)
+
+    def send_text_message(self, message) -> Future:
+        return self.gather([self.submit(chat_id, 'send_text_message', message, chat_id=chat_id)
+                            for chat_id in self.chat_ids])
+
+    def send_image_message(self, image, filename: str = '', caption: str = '',
+                           as_document: bool = True) -> Future:
+        return self.fan_out_media('send_image_message', self.chat_ids,
+                                  lambda chat_id, file_id: dict(image=image,
+                                                                filename=filename, caption=caption,
+                                                                as_document=as_document, chat_id=chat_id,
+                                                                file_id=file_id))
+
+    def edit_image_message(self, chat_id: str, message_id: str, image, filename: str = '') -> Future:
+        return self.submit(chat_id, 'edit_image_message', chat_id=chat_id, message_id=message_id,
+                           image=image, filename=filename)
+
+    def edit_image_messages(self, message_ids: Dict[str, str], image, filename: str = '') -> Future:
+        """
+        Edit the image of a message sent to several chats, like 'send_image_message' does, uploading it only once.
+        :param message_ids: chat id => message id, as in the result of 'send_image_message'
+        """
+        return self.fan_out_media('edit_image_message', list(message_ids.keys()),
+                                  lambda chat_id, file_id: dict(chat_id=chat_id, message_id=message_ids[chat_id],
+                                                                image=image,
+                                                                filename=filename, file_id=file_id))
+
+    def pin_message(self, chat_id: str, message_id: str) -> Future:
+        return self.submit(chat_id, 'pin_message', chat_id=chat_id, message_id=message_id)
+
+    def unpin_message(self, chat_id: str, message_id: str) -> Future:
+        return self.submit(chat_id, 'unpin_message', chat_id=chat_id, message_id=message_id)
+
+    def unpin_all_messages(self, chat_id: str) -> Future:
+        return self.submit(chat_id, 'unpin_all_messages', chat_id=chat_id)
+
+    def submit(self, lane_chat_id: str, method_name: str, *args, **kwargs) -> Future:
+        """
+        Queue a call of 'TelegramBot.method_name' on the lane of lane_chat_id.
+        :return: Future of the (status, info_dict) tuple returned by the call. If the lane is full, the request is
+        dropped and the future already holds an 'ERROR'.
+        """
+        request = OutboundRequest(method_name=method_name, args=args, kwargs=kwargs)
+        queue, _, _ = self.chat_lane(str(lane_chat_id))
+        if not queue.put(request):
+            request.future.set_result(('ERROR', {'error_code': 0,
+                                                 'description': f'Outbound queue of chat {lane_chat_id} is full'}))
+        return request.future
+
+    def fan_out_media(self, method_name: str, chat_ids: List[str], make_kwargs: Callable) -> Future:
+        """
+        Call 'method_name' for the first chat with the media, and once it's uploaded, for all other chats with its
+        'file_id' only. If the upload failed, other chats get the media itself.
+        :param make_kwargs: Called with (chat id, file id or None), returns kwargs of the call for that chat
+        :return: Future of the merged result of all chats
+        """
+        merged_future = Future()
+        if not chat_ids:
+            merged_future.set_result(('ERROR', {'error_code': 0, 'description': 'No chat to send to'}))
+            return merged_future
+
+        first_chat_id, other_chat_ids = chat_ids[0], chat_ids[1:]
+        first_future = self.submit(first_chat_id, method_name, **make_kwargs(first_chat_id, None))
+
+        def on_uploaded(future: Future):
+            status, info_dict = future.result()
+            file_id = info_dict.get('file_id') if status == 'OK' else None
+            other_futures = [self.submit(chat_id, method_name, **make_kwargs(chat_id, file_id))
+                             for chat_id in other_chat_ids]
+            self.gather([first_future] + other_futures, chat_ids, merged_future)
+
+        first_future.add_done_callback(on_uploaded)
+        return merged_future
+
+    def gather(self, futures: List[Future], chat_ids: List[str] = None, merged_future: Future = None) -> Future:
+        """
+        :param futures: One future per chat, in the same order as 'chat_ids' (all chats of the bot by default)
+        :return: Future of the merged result of all chats, see 'merge_results'
+        """
+        chat_ids = chat_ids or self.chat_ids
+        merged_future = merged_future or Future()
+        remaining = [len(futures)]
+        remaining_lock = threading.Lock()
+
+        def on_done(_):
+            with remaining_lock:
+                remaining[0] -= 1
+                if remaining[0] > 0:
+                    return
+            merged_future.set_result(self.merge_results(chat_ids, [future.result() for future in futures]))
+
+        for future in futures:
+            future.add_done_callback(on_done)
+        return merged_future
+
+    @staticmethod
+    def merge_results(chat_ids: List[str], results: List[Tuple[str, Dict]]) -> Tuple[str, Dict]:
+        """
+        :return: Result of the first chat, with 'message_ids' added: chat id => message id of every chat that got the
+        message. 'ERROR' with the first error if any chat failed.
+        """
+        message_ids = {chat_id: info_dict['message_id'] for chat_id, (status, info_dict) in zip(chat_ids, results)
+                       if status == 'OK' and 'message_id' in info_dict}
+        for status, info_dict in results:
+            if status == 'ERROR':
+                return 'ERROR', dict(info_dict, message_ids=message_ids)
+        return results[0][0], dict(results[0][1], message_ids=message_ids)
+
+    def chat_lane(self, chat_id: str) -> Tuple[BoundedQueue, QueueWorker, TokenBucket]:
+        with self.lanes_lock:
+            if chat_id not in self.chat_lanes:
+                # Dropping the newest keeps the futures honest: it is the only request we can still fail.
+                queue = BoundedQueue(max_size=self.queue_size, overflow_policy=OverflowPolicy.DROP_NEWEST,
+                                     name=f'TelegramQueue{chat_id}')
+                chat_bucket = TokenBucket(rate_per_sec=self.chat_messages_per_sec, burst=self.chat_burst)
+                worker = QueueWorker(queue=queue, target=lambda request: self.process_request(request, chat_bucket),
+                                     name=f'TelegramWorker{chat_id}')
+                worker.start()
+                self.chat_lanes[chat_id] = (queue, worker, chat_bucket)
+            return self.chat_lanes[chat_id]
+
+    def process_request(self, request: OutboundRequest, chat_bucket: TokenBucket):
+        """
+        Runs on the lane thread of the chat, retries until the request succeeds or fails for good.
+        """
+        while True:
+            self.global_bucket.acquire()
+            chat_bucket.acquire()
+            try:
+                status, info_dict = getattr(self.telegram_bot, request.method_name)(*request.args, **request.kwargs)
+            except Exception as exception:
+                status, info_dict = 'ERROR', {'error_code': 0,
+                                              'description': f'{type(exception).__name__}: {exception}'}
+
+            delay_sec = self.retry_delay(request, status, info_dict)
+            if delay_sec is None:
+                request.future.set_result((status, info_dict))
+                return
+
+            print(f'\n[Telegram - {request.method_name}][{info_dict.get("error_code")}] Retrying in {delay_sec} sec')
+            time.sleep(delay_sec)
+
+    def retry_delay(self, request: OutboundRequest, status: str, info_dict: Dict[str, Any]) -> Optional[float]:
+        """
+        :return: How long to wait before retrying the request, or None if it shouldn't be retried.
+        """
+        if status != 'ERROR':
+            return None
+
+        error_code = info_dict.get('error_code', 0)
+        if error_code == 429:
+            # Rate limited, not failed: telegram takes it after 'retry_after', so this doesn't count as a retry.
+            # Waits still add up, so a chat telegram keeps rate limiting can't hold up its lane forever.
+            retry_after = (info_dict.get('parameters') or dict()).get('retry_after', self.retry_delay_sec)
+            if request.rate_limited_wait_sec + retry_after > self.max_rate_limited_wait_sec:
+                print(f'\n[Telegram - {request.method_name}][429] Still rate limited after waiting '
+                      f'{request.rate_limited_wait_sec:g} sec, giving up')
+                return None
+            request.rate_limited_wait_sec += retry_after
+            return retry_after
+        if (error_code == 0 or error_code >= 500) and request.attempt < self.max_retries:
+            request.attempt += 1
+            return self.retry_delay_sec * (2 ** (request.attempt - 1))
+        return None
+
+    def backlog(self) -> int:
+        return sum(queue.backlog() for queue, _, _ in list(self.chat_lanes.values()))
+
+    def wait_until_idle(self, timeout: float = None) -> bool:
+        """
+        Wait until every queued request is done, including the ones queued by callbacks of finished requests.
+        :return: False if it timed out.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            for queue, _, _ in list(self.chat_lanes.values()):
+                remaining = None if deadline is None else max(0.0, deadline - time.monotonic())
+                if not queue.join(remaining):
+                    return False
+            if all(queue.unfinished_count() <= 0 for queue, _, _ in list(self.chat_lanes.values())):
+                return True
+
+    def stop(self):
+        for queue, _, _ in list(self.chat_lanes.values()):
+            queue.close()
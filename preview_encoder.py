@@ -0,0 +1,55 @@
+#!/bin/env python3
+import io
+from typing import Union
+
+from PIL import Image
+
+
+class PreviewEncoder:
+    """
+    Re-encodes previews to fit an upload budget: at most 'max_dimension' pixels on the longer side and at most
+    'max_bytes' large. Quality is lowered step by step down to 'min_quality' first, then the image is scaled down,
+    until it fits. Previews that already fit are returned untouched.
+    """
+
+    # Never scale below this, a preview this small is useless anyway
+    MIN_DIMENSION = 320
+
+    def __init__(self, max_dimension: int = 2048, quality: int = 85, min_quality: int = 50, progressive: bool = True,
+                 max_bytes: int = 1048576):
+        self.max_dimension = max_dimension
+        self.quality = quality
+        self.min_quality = min(min_quality, quality)
+        self.progressive = progressive
+        self.max_bytes = max_bytes
+
+    def encode(self, image: Union[bytes, memoryview]) -> Union[bytes, memoryview]:
+        """
+        :param image: Raw bytes of the preview
+        :return: Raw bytes of the preview that fits the budget, the given bytes if it already fits
+        """
+        img = Image.open(io.BytesIO(image))
+        if len(image) <= self.max_bytes and max(img.size) <= self.max_dimension:
+            return image
+
+        # JPEG previews are decoded at a reduced scale right away, see 'ThumbnailService'
+        img.draft('RGB', (self.max_dimension, self.max_dimension))
+        img = img.convert('RGB')
+        img.thumbnail((self.max_dimension, self.max_dimension))
+
+        quality = self.quality
+        while True:
+            encoded = self.save(img, quality)
+            if len(encoded) <= self.max_bytes:
+                return encoded
+            if quality > self.min_quality:
+                quality = max(self.min_quality, quality - 10)
+            elif max(img.size) * 3 // 4 >= self.MIN_DIMENSION:
+                img = img.resize((img.size[0] * 3 // 4, img.size[1] * 3 // 4), Image.LANCZOS)
+            else:
+                return encoded
+
+    def save(self, img: Image.Image, quality: int) -> bytes:
+        encoded = io.BytesIO()
+        img.save(encoded, format='JPEG', quality=quality, progressive=self.progressive, optimize=True)
+        return encoded.getvalue()
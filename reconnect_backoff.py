@@ -0,0 +1,28 @@
+#!/bin/env python3
+import random
+
+
+class ReconnectBackoff:
+    """
+    Exponential backoff with jitter for reconnecting to voyager application server.
+    Delay doubles on every failed attempt up to 'max_delay_sec', and is randomly shortened by up to 'jitter_ratio'
+    so that several bots dropped by the same router reboot don't all hammer the server at the same moment.
+    """
+
+    def __init__(self, initial_delay_sec: float = 1, max_delay_sec: float = 512, jitter_ratio: float = 0.5):
+        self.initial_delay_sec = initial_delay_sec
+        self.max_delay_sec = max_delay_sec
+        self.jitter_ratio = min(max(jitter_ratio, 0.0), 1.0)
+        self.attempt = 0
+
+    def next_delay_sec(self) -> float:
+        """
+        :return: How long to wait before the next reconnect attempt, in seconds.
+        """
+        delay_sec = min(self.max_delay_sec, self.initial_delay_sec * (2 ** self.attempt))
+        if delay_sec < self.max_delay_sec:
+            self.attempt += 1
+        return delay_sec * (1.0 - self.jitter_ratio * random.random())
+
+    def reset(self):
+        self.attempt = 0
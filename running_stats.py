@@ -0,0 +1,124 @@
+#!/bin/env python3
+import math
+from bisect import bisect_right, insort
+
+
+class RunningStat:
+    """
+    Mean, variance, min and max of a stream of values, updated in O(1) per value with Welford's algorithm, so that
+    they don't have to be recomputed over every value seen so far.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0  # sum of squared differences from the mean
+        self.min = math.inf
+        self.max = -math.inf
+
+    def add(self, value: float):
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+
+    def stdev(self) -> float:
+        """
+        :return: Sample standard deviation, same as 'statistics.stdev'. 0 for less than 2 values.
+        """
+        if self.count < 2:
+            return 0.0
+        return math.sqrt(self.m2 / (self.count - 1))
+
+
+class P2Quantile:
+    """
+    Streaming estimate of a quantile with the P-Square algorithm (Jain & Chlamtac, 1985): 5 markers track the min,
+    the max, the quantile and the points halfway to it, and are moved along a parabola as values arrive.
+    Constant memory, O(1) per value.
+
+    P-Square is off by a lot for tail quantiles of small samples, so the first 'exact_count' values are kept, and
+    the quantile is exact, like 'numpy.percentile', until then. The markers start from them.
+    """
+
+    def __init__(self, quantile: float = 0.5, exact_count: int = 500):
+        self.quantile = quantile
+        self.exact_count = max(5, exact_count)
+        self.count = 0
+        self.values = list()  # sorted, until there are more than 'exact_count' values
+        self.heights = list()  # marker heights
+        self.positions = list()  # actual marker positions, 0 based
+        self.position_increments = [0, quantile / 2, quantile, (1 + quantile) / 2, 1]
+        self.desired_positions = list()
+
+    def add(self, value: float):
+        self.count += 1
+        if self.count <= self.exact_count:
+            insort(self.values, value)
+            return
+        if not self.heights:
+            self.place_markers()
+
+        heights = self.heights
+        if value < heights[0]:
+            heights[0] = value
+            cell = 0
+        elif value >= heights[4]:
+            heights[4] = value
+            cell = 3
+        else:
+            cell = bisect_right(heights, value) - 1
+
+        positions = self.positions
+        for i in range(cell + 1, 5):
+            positions[i] += 1
+        for i in range(5):
+            self.desired_positions[i] += self.position_increments[i]
+
+        for i in (1, 2, 3):
+            offset = self.desired_positions[i] - positions[i]
+            if (offset >= 1 and positions[i + 1] - positions[i] > 1) or \
+                    (offset <= -1 and positions[i - 1] - positions[i] < -1):
+                step = 1 if offset > 0 else -1
+                height = self.parabolic(i, step)
+                if not heights[i - 1] < height < heights[i + 1]:
+                    height = heights[i] + step * (heights[i + step] - heights[i]) / (positions[i + step] - positions[i])
+                heights[i] = height
+                positions[i] += step
+
+    def place_markers(self):
+        """
+        Start the markers from the exact values, at the ranks they should be at, and drop the values.
+        """
+        last_index = len(self.values) - 1
+        self.desired_positions = [last_index * increment for increment in self.position_increments]
+        self.positions = [round(position) for position in self.desired_positions]
+        # Markers must stay on distinct ranks
+        for i in (1, 2, 3):
+            self.positions[i] = min(max(self.positions[i], self.positions[i - 1] + 1), last_index - (4 - i))
+        self.heights = [self.values[position] for position in self.positions]
+        self.values = list()
+
+    def parabolic(self, i: int, step: int) -> float:
+        heights, positions = self.heights, self.positions
+        return heights[i] + step / (positions[i + 1] - positions[i - 1]) * (
+                (positions[i] - positions[i - 1] + step) * (heights[i + 1] - heights[i]) /
+                (positions[i + 1] - positions[i]) +
+                (positions[i + 1] - positions[i] - step) * (heights[i] - heights[i - 1]) /
+                (positions[i] - positions[i - 1]))
+
+    def value(self) -> float:
+        """
+        :return: The estimated quantile, 0 if there are no values yet.
+        """
+        if self.heights:
+            return self.heights[2]
+        if self.count == 0:
+            return 0.0
+        # Exact, interpolated between the closest ranks like 'numpy.percentile'
+        rank = (self.count - 1) * self.quantile
+        lower = int(rank)
+        upper = min(lower + 1, self.count - 1)
+        return self.values[lower] + (self.values[upper] - self.values[lower]) * (rank - lower)
@@ -1,62 +1,160 @@
 #!/bin/env python3
-import base64
 import io
+import math
+import threading
 from collections import defaultdict
-from statistics import mean, stdev
 from typing import Tuple
 
+import matplotlib
 import numpy as np
+
+# Plots are rendered on handler lane threads. GUI backends like TkAgg, the default on desktops, must stay on the
+# main thread, so render to memory only. This has to happen before anything imports pyplot.
+matplotlib.use('Agg')
+
 from matplotlib import axes
-from matplotlib import pyplot as plt
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
 
 from data_structure.filter_info import ExposureInfo
 from data_structure.focus_result import FocusResult
+from growable_array import GrowableArray
+from running_stats import P2Quantile, RunningStat
+
+# Max number of guide samples plotted, when 'guiding_error_plot.max_plot_points' is not set
+DEFAULT_MAX_PLOT_POINTS = 2000
 
 
 class SequenceStat:
-    def __init__(self, name: str = ''):
+    def __init__(self, name: str = '', max_exposure_count: int = -1, max_guide_sample_count: int = -1):
+        """
+        :param max_exposure_count: Only the latest exposures are kept for plots, -1 means all of them
+        :param max_guide_sample_count: Only the latest guide samples are kept for plots, -1 means all of them
+        """
         # target name, like 'M31', or 'NGC 6992'
         self.name = name
-        self.exposure_info_list = list()
         self.focus_result_list = list()
-        self.guide_x_error_list = list()  # list of guide error on x axis in pixel
-        self.guide_y_error_list = list()  # list of guide error on y axis in pixel
+
+        # Exposures and guide samples are kept column by column in typed arrays, plots read them as NumPy views.
+        # Aggregates below cover the whole sequence, even if old exposures and samples were dropped.
+        self.exposure_times = GrowableArray(np.float32, max_size=max_exposure_count)  # in seconds
+        self.exposure_hfds = GrowableArray(np.float32, max_size=max_exposure_count)
+        self.exposure_star_indices = GrowableArray(np.float32, max_size=max_exposure_count)
+        self.exposure_timestamps = GrowableArray(np.float64, max_size=max_exposure_count)
+        self.exposure_filter_ids = GrowableArray(np.int16, max_size=max_exposure_count)  # index into 'filter_names'
+        self.filter_names = list()  # normalized filter names, in the order they were first used
+        self.filter_ids = dict()  # filter name => index into 'filter_names'
+
+        # guide errors on x and y axis in pixel
+        self.guide_x_errors = GrowableArray(np.float32, initial_capacity=4096, max_size=max_guide_sample_count)
+        self.guide_y_errors = GrowableArray(np.float32, initial_capacity=4096, max_size=max_guide_sample_count)
+        self.last_guide_error = None
+        # Bumped whenever the stats change, so that plots of an unchanged sequence don't need to be redrawn
+        self.version = 0
+
+        # Aggregates are updated as samples arrive, so that their cost doesn't grow with the length of the night
+        self.exposure_time_by_filter = defaultdict(float)  # filter name => cumulative exposure time in seconds
+        self.guide_x_error_stat = RunningStat()
+        self.guide_y_error_stat = RunningStat()
+        self.guide_abs_x_error_stat = RunningStat()
+        self.guide_abs_y_error_stat = RunningStat()
+        self.guide_distance_stat = RunningStat()  # total error, sqrt(x^2 + y^2)
+        self.guide_distance_95p = P2Quantile(0.95)
 
     def add_exposure(self, exposure: ExposureInfo):
         if exposure.exposure_time > 30:
-            self.exposure_info_list.append(exposure)
+            filter_name = exposure.filter_name
+            if filter_name not in self.filter_ids:
+                self.filter_ids[filter_name] = len(self.filter_names)
+                self.filter_names.append(filter_name)
+            self.exposure_times.append(exposure.exposure_time)
+            self.exposure_hfds.append(exposure.hfd)
+            self.exposure_star_indices.append(exposure.star_index)
+            self.exposure_timestamps.append(exposure.timestamp)
+            self.exposure_filter_ids.append(self.filter_ids[filter_name])
+            self.exposure_time_by_filter[exposure.filter_name] += exposure.exposure_time
+            self.version += 1
 
     def add_focus_result(self, focus_result: FocusResult):
         focus_result.recommended_index = self.exposure_count() - 0.5
         self.focus_result_list.append(focus_result)
+        self.version += 1
 
     def add_guide_error(self, guide_error: tuple):
-        if len(self.guide_x_error_list) > 0 and self.guide_x_error_list[-1] == guide_error[0] and \
-                self.guide_y_error_list[-1] == guide_error[1]:
+        if guide_error == self.last_guide_error:
             return
-        self.guide_x_error_list.append(guide_error[0])
-        self.guide_y_error_list.append(guide_error[1])
+        self.last_guide_error = guide_error
+        error_x, error_y = guide_error
+        self.guide_x_errors.append(error_x)
+        self.guide_y_errors.append(error_y)
+
+        distance = math.sqrt(error_x ** 2 + error_y ** 2)
+        self.guide_x_error_stat.add(error_x)
+        self.guide_y_error_stat.add(error_y)
+        self.guide_abs_x_error_stat.add(abs(error_x))
+        self.guide_abs_y_error_stat.add(abs(error_y))
+        self.guide_distance_stat.add(distance)
+        self.guide_distance_95p.add(distance)
+        self.version += 1
 
     def exposure_count(self):
-        return len(self.exposure_info_list)
+        """
+        :return: Number of exposures of the sequence, dropped ones included
+        """
+        return self.exposure_times.appended_count()
+
+    def guide_sample_count(self):
+        """
+        :return: Number of guide samples kept
+        """
+        return len(self.guide_x_errors)
 
     def exposure_time_stat_dictionary(self):
         """
         Exposure time stats in a dictionary form.
         Key is the filter name, normalized, value is the cumulative time in seconds.
         """
-        result = defaultdict(float)
-        for expo in self.exposure_info_list:
-            result[expo.filter_name] += expo.exposure_time
-        return result
+        return dict(self.exposure_time_by_filter)
+
+
+def min_max_downsample(*series: np.ndarray, max_points: int = DEFAULT_MAX_PLOT_POINTS) -> np.ndarray:
+    """
+    Shape preserving downsampling of time series of the same length: they are split into 'max_points' / 2 buckets,
+    and the min and the max of every series in every bucket are kept, so that spikes still show.
+    :return: Sorted indices of the samples to keep, all of them if there are no more than 'max_points'.
+    """
+    sample_count = len(series[0])
+    if max_points <= 0 or sample_count <= max_points:
+        return np.arange(sample_count)
+
+    bucket_count = max(1, max_points // (2 * len(series)))
+    bucket_size = -(-sample_count // bucket_count)  # ceil
+    bucket_starts = np.arange(0, sample_count, bucket_size)
+    kept_ids = list()
+    for values in series:
+        # Pad the last bucket with NaNs, which are never picked, to split the samples in a single reshape
+        padded = np.full(len(bucket_starts) * bucket_size, np.nan)
+        padded[:sample_count] = values
+        buckets = padded.reshape(-1, bucket_size)
+        kept_ids.append(bucket_starts + np.nanargmin(buckets, axis=1))
+        kept_ids.append(bucket_starts + np.nanargmax(buckets, axis=1))
+    return np.unique(np.concatenate(kept_ids))
+
+
+def stride_downsample(sample_count: int, max_points: int = DEFAULT_MAX_PLOT_POINTS) -> np.ndarray:
+    """
+    :return: Indices of 'max_points' evenly spaced samples, all of them if there are no more than 'max_points'.
+    """
+    if max_points <= 0 or sample_count <= max_points:
+        return np.arange(sample_count)
+    return np.linspace(0, sample_count - 1, max_points).astype(np.int64)
 
 
 class StatPlotter:
     def __init__(self, plotter_configs: dict = None):
         self.plotter_configs = plotter_configs
 
-        plt.ioff()
-        plt.rcParams.update({'text.color': '#F5F5F5', 'font.size': 40, 'font.weight': 'bold',
+        matplotlib.rcParams.update({'text.color': '#F5F5F5', 'font.size': 40, 'font.weight': 'bold',
                              'axes.edgecolor': '#F5F5F5', 'figure.facecolor': '#212121',
                              'xtick.color': '#F5F5F5', 'ytick.color': '#F5F5F5'})
 
@@ -64,6 +162,10 @@ class StatPlotter:
 
         self.filter_meta = self.plotter_configs.filter_styles
 
+        # Figures are not shared, but matplotlib's font and text caches are, so a plotter shared by several rigs
+        # renders one figure at a time.
+        self.render_lock = threading.Lock()
+
     def _circle(self, ax: axes.Axes = None, origin: Tuple[float, float] = (0, 0), radius: float = 1.0, **kwargs):
         angle = np.linspace(0, 2 * np.pi, 150)
         x = radius * np.cos(angle) + origin[0]
@@ -72,19 +174,14 @@ class StatPlotter:
         ax.plot(x, y, **kwargs)
 
     def hfd_plot(self, ax: axes.Axes = None, sequence_stat: SequenceStat = None, target_name: str = ''):
-        img_ids = range(sequence_stat.exposure_count())
-        hfd_values = list()
-        dot_colors = list()
-        star_indices = list()
-        for exposure_info in sequence_stat.exposure_info_list:
-            hfd_values.append(exposure_info.hfd)
-            star_indices.append(exposure_info.star_index)
-            if exposure_info.filter_name in self.filter_meta:
-                color = self.filter_meta[exposure_info.filter_name]['color']
-            else:
-                color = '#660874'
-
-            dot_colors.append(color)
+        first_img_id = sequence_stat.exposure_times.dropped_count
+        img_ids = np.arange(first_img_id, sequence_stat.exposure_count())
+        hfd_values = sequence_stat.exposure_hfds.view()
+        star_indices = sequence_stat.exposure_star_indices.view()
+        # One color per filter, picked for every exposure by its filter id
+        filter_colors = np.array([self.filter_meta[filter_name]['color'] if filter_name in self.filter_meta
+                                  else '#660874' for filter_name in sequence_stat.filter_names] or ['#660874'])
+        dot_colors = filter_colors[sequence_stat.exposure_filter_ids.view()]
 
         ax.set_facecolor('#212121')
 
@@ -94,6 +191,9 @@ class StatPlotter:
             focus_hfd_value = list()
             focus_colors = list()
             for focus_result in sequence_stat.focus_result_list:
+                if focus_result.recommended_index < first_img_id - 0.5:
+                    # Before the oldest exposure still shown
+                    continue
                 focus_hfd_value.append(focus_result.hfd)
                 focus_colors.append(focus_result.filter_color)
                 focus_index.append(focus_result.recommended_index)
@@ -143,17 +243,14 @@ class StatPlotter:
                      target_name: str = ''):
         config = self.plotter_configs.guiding_error_plot
         ax_main.set_facecolor('#212121')
-        ax_main.plot(sequence_stat.guide_x_error_list, color='#F44336', linewidth=2)
-        ax_main.plot(sequence_stat.guide_y_error_list, color='#2196F3', linewidth=2)
-
-        abs_x_list = list()
-        abs_y_list = list()
-        distance_list = list()
-        for idx, x_error in enumerate(sequence_stat.guide_x_error_list):
-            y_error = sequence_stat.guide_y_error_list[idx]
-            abs_x_list.append(abs(x_error))
-            abs_y_list.append(abs(y_error))
-            distance_list.append(np.sqrt(x_error ** 2 + y_error ** 2))
+        guide_x_errors = sequence_stat.guide_x_errors.view()
+        guide_y_errors = sequence_stat.guide_y_errors.view()
+        # Matplotlib's cost grows with the number of points, so long sequences are plotted from a fixed number of them
+        max_points = config.get('max_plot_points', DEFAULT_MAX_PLOT_POINTS)
+        sample_ids = min_max_downsample(guide_x_errors, guide_y_errors, max_points=max_points)
+        first_sample_id = sequence_stat.guide_x_errors.dropped_count
+        ax_main.plot(sample_ids + first_sample_id, guide_x_errors[sample_ids], color='#F44336', linewidth=2)
+        ax_main.plot(sample_ids + first_sample_id, guide_y_errors[sample_ids], color='#2196F3', linewidth=2)
 
         unit = 'Pixel' if config['unit'] == 'PIXEL' else 'Arcsec'
         scale = 1.0 if config['unit'] == 'PIXEL' else float(config['scale'])
@@ -167,22 +264,24 @@ class StatPlotter:
                          'Y={y_mean:.03f}{unit_short}/{y_min:.03f}{unit_short}/{y_max:.03f}{unit_short}/{y_std:.03f}{unit_short}\n' \
                          'Total RMS: mean={t_mean:.03f}{unit_short}/95P={t_95:.03f}{unit_short}/STD={t_std:.03f}{unit_short}'
 
+        x_stat = sequence_stat.guide_x_error_stat
+        y_stat = sequence_stat.guide_y_error_stat
+        distance_stat = sequence_stat.guide_distance_stat
+        distance_95p = sequence_stat.guide_distance_95p.value()
         ax_main.set_title(title_template.format(
             unit=unit,
             unit_short=unit_short,
-            x_mean=mean(abs_x_list),
-            x_min=min(sequence_stat.guide_x_error_list) * scale,
-            x_max=max(sequence_stat.guide_x_error_list) * scale,
-            x_std=stdev(sequence_stat.guide_x_error_list) * scale if len(
-                sequence_stat.guide_x_error_list) >= 2 else 0.0,
-            y_mean=mean(abs_y_list) * scale,
-            y_min=min(sequence_stat.guide_y_error_list) * scale,
-            y_max=max(sequence_stat.guide_y_error_list) * scale,
-            y_std=stdev(sequence_stat.guide_y_error_list) * scale if len(
-                sequence_stat.guide_y_error_list) >= 2 else 0.0,
-            t_mean=mean(distance_list) * scale,
-            t_95=np.percentile(distance_list, 95) * scale,
-            t_std=stdev(distance_list) * scale if len(distance_list) >= 2 else 0.0,
+            x_mean=sequence_stat.guide_abs_x_error_stat.mean * scale,
+            x_min=x_stat.min * scale,
+            x_max=x_stat.max * scale,
+            x_std=x_stat.stdev() * scale,
+            y_mean=sequence_stat.guide_abs_y_error_stat.mean * scale,
+            y_min=y_stat.min * scale,
+            y_max=y_stat.max * scale,
+            y_std=y_stat.stdev() * scale,
+            t_mean=distance_stat.mean * scale,
+            t_95=distance_95p * scale,
+            t_std=distance_stat.stdev() * scale,
         ))
 
         ax_scatter.set_facecolor('#212121')
@@ -196,21 +295,26 @@ class StatPlotter:
         self._circle(ax=ax_scatter, origin=(0, 0), radius=2, linestyle='--', color='#66BB6A', linewidth=2)
         self._circle(ax=ax_scatter, origin=(0, 0), radius=1, linestyle='--', color='#66BB6A', linewidth=2)
 
-        self._circle(ax=ax_scatter, origin=(0, 0), radius=mean(distance_list) * scale, linestyle='-', color='#B2EBF2',
+        self._circle(ax=ax_scatter, origin=(0, 0), radius=distance_stat.mean * scale, linestyle='-', color='#B2EBF2',
                      linewidth=4)
-        self._circle(ax=ax_scatter, origin=(0, 0), radius=np.percentile(distance_list, 95) * scale, linestyle='-',
+        self._circle(ax=ax_scatter, origin=(0, 0), radius=distance_95p * scale, linestyle='-',
                      color='#B2EBF2',
                      linewidth=4)
-        guide_x_error_list = [element * scale for element in sequence_stat.guide_x_error_list]
-        guide_y_error_list = [element * scale for element in sequence_stat.guide_y_error_list]
-
-        ax_scatter.scatter(x=guide_x_error_list, y=guide_y_error_list, color='#26C6DA')
+        # Extremes only would hollow out the scatter, evenly spaced samples keep its density
+        sample_ids = stride_downsample(len(guide_x_errors), max_points=max_points)
+        ax_scatter.scatter(x=guide_x_errors[sample_ids] * scale, y=guide_y_errors[sample_ids] * scale, color='#26C6DA')
 
     def plot(self, sequence_stat: SequenceStat = None):
         if sequence_stat is None:
             return
 
-        fig = plt.figure(figsize=(30, 10 * self.figure_count), constrained_layout=True)
+        with self.render_lock:
+            return self._plot(sequence_stat=sequence_stat)
+
+    def _plot(self, sequence_stat: SequenceStat):
+        # A standalone figure, not one managed by pyplot, so nothing global is touched and nothing is left open
+        fig = Figure(figsize=(30, 10 * self.figure_count), constrained_layout=True)
+        FigureCanvasAgg(fig)
 
         if 'GuidingPlot' in self.plotter_configs.types:
             gridspec = fig.add_gridspec(nrows=self.figure_count, ncols=2,
@@ -230,7 +334,7 @@ class StatPlotter:
             self.exposure_plot(ax=ax, sequence_stat=sequence_stat, target_name=sequence_stat.name)
             figure_index += 1
 
-        if 'GuidingPlot' in self.plotter_configs.types and len(sequence_stat.guide_x_error_list) > 0:
+        if 'GuidingPlot' in self.plotter_configs.types and sequence_stat.guide_sample_count() > 0:
             ax_main = fig.add_subplot(gridspec[figure_index:figure_index + 2, 0])
             ax_scatter = fig.add_subplot(gridspec[figure_index, 1])
 
@@ -241,11 +345,7 @@ class StatPlotter:
         # fig.tight_layout()
 
         img_bytes = io.BytesIO()
-        plt.savefig(img_bytes, format='jpg')
-        img_bytes.seek(0)
-        base64_img = base64.b64encode(img_bytes.read())
-
-        # Prevent RuntimeWarning 'More than 20 figures have been opened' from matplotlib
-        plt.close('all')
+        fig.savefig(img_bytes, format='jpg')
 
-        return base64_img
+        # A view of the JPEG in the buffer, nothing is copied
+        return img_bytes.getbuffer()
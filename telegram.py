@@ -1,150 +1,201 @@
 #!/bin/env python3
 
-import base64
-import io
-import json
-import tempfile
 from typing import Tuple, Dict, Any
 
 import requests
-from PIL import Image
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
+import json_codec
 from configs import ConfigBuilder
+from data_structure.lazy_base64_blob import image_bytes
+from thumbnail_service import ThumbnailService
 
 
 class TelegramBot:
     def __init__(self, config=None):
         self.config = config
         self.token = self.config.telegram_setting.bot_token
-        self.chat_id = self.config.telegram_setting.chat_id
+        self.chat_id = str(self.config.telegram_setting.chat_id)
+        # Every chat that gets the messages, 'chat_id' is the first one
+        self.chat_ids = [str(chat_id) for chat_id in self.config.telegram_setting.chat_ids]
 
+        # The telegram bot API, or a stand-in like 'fake_telegram_server' for load tests
+        api_url = f'{self.config.telegram_http.api_base_url.rstrip("/")}/bot{self.token}'
         self.urls = {
-            'text': f'https://api.telegram.org/bot{self.token}/sendMessage',
-            'doc': f'https://api.telegram.org/bot{self.token}/sendDocument',
-            'edit_message_media': f'https://api.telegram.org/bot{self.token}/editMessageMedia',
-            'pic': f'https://api.telegram.org/bot{self.token}/sendPhoto',
-            'pin_message': f'https://api.telegram.org/bot{self.token}/pinChatMessage',
-            'unpin_message': f'https://api.telegram.org/bot{self.token}/unpinChatMessage',
-            'unpin_all_messages': f'https://api.telegram.org/bot{self.token}/unpinAllChatMessages',
+            'text': f'{api_url}/sendMessage',
+            'doc': f'{api_url}/sendDocument',
+            'edit_message_media': f'{api_url}/editMessageMedia',
+            'pic': f'{api_url}/sendPhoto',
+            'pin_message': f'{api_url}/pinChatMessage',
+            'unpin_message': f'{api_url}/unpinChatMessage',
+            'unpin_all_messages': f'{api_url}/unpinAllChatMessages',
         }
 
-    def send_text_message(self, message) -> Tuple[str, Dict[str, Any]]:
-        payload = {'chat_id': self.chat_id, 'text': message, 'parse_mode': 'html'}
-        send_text_message_response = requests.post(self.urls['text'], data=payload)
-        response_json = json.loads(send_text_message_response.text)
+        # Telegram wants document thumbnails no larger than 320 pixels on either side
+        self.thumbnail_service = ThumbnailService(max_size=(320, 320))
+
+        http_config = self.config.telegram_http
+        self.timeout = (http_config.connect_timeout_sec, http_config.read_timeout_sec)
+        self.session = self.create_session(pool_size=http_config.pool_size, max_retries=http_config.max_retries,
+                                           backoff_factor=http_config.backoff_factor)
+
+    @staticmethod
+    def create_session(pool_size: int = 4, max_retries: int = 3, backoff_factor: float = 0.5) -> requests.Session:
+        """
+        One keep-alive session for every request to telegram, so that a TLS handshake is paid once per connection
+        instead of once per message. Up to 'pool_size' connections are kept open for concurrent callers.
+        Only failures to connect are retried here, with exponential backoff, since those requests never reached
+        telegram. Everything else, 5xx answers included, is retried by 'OutboundTelegramScheduler' alone, so one
+        message isn't retried by two layers on top of each other.
+        """
+        retry = Retry(total=max_retries, connect=max_retries, read=0, status=0, other=0, redirect=0,
+                      backoff_factor=backoff_factor, raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+        session = requests.Session()
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        return session
+
+    def _post(self, url_name: str, data: Dict[str, Any], files: Dict[str, Any] = None) -> Tuple[str, Dict[str, Any]]:
+        """
+        Post a request to telegram bot API through the pooled session.
+        :return: ('OK', the whole response) or ('ERROR', response without 'ok'). Network errors and unreadable
+        responses are 'ERROR' too, with 'error_code' 0, so callers handle every failure the same way.
+        """
+        try:
+            response = self.session.post(self.urls[url_name], data=data, files=files, timeout=self.timeout)
+            response_json = json_codec.loads(response.content)
+        except (requests.RequestException, ValueError) as exception:
+            return 'ERROR', {'error_code': 0, 'description': f'{type(exception).__name__}: {exception}'}
+
+        if response_json.pop('ok', False):
+            return 'OK', response_json
+        return 'ERROR', response_json
+
+    @staticmethod
+    def media_message_info(response_json: Dict[str, Any]) -> Dict[str, str]:
+        """
+        :return: chat_id and message_id of a photo or document message, and the file_id of its media.
+        Sending 'file_id' instead of the file reuses an upload, in any chat.
+        """
+        result = response_json['result']
+        if 'document' in result:
+            file_id = result['document']['file_id']
+        else:
+            # Telegram keeps several sizes of a photo, the last one is the original
+            file_id = result['photo'][-1]['file_id']
+        return {
+            'chat_id': str(result['chat']['id']),
+            'message_id': str(result['message_id']),
+            'file_id': file_id
+        }
 
-        if response_json['ok']:
+    def send_text_message(self, message, chat_id: str = None) -> Tuple[str, Dict[str, Any]]:
+        payload = {'chat_id': chat_id or self.chat_id, 'text': message, 'parse_mode': 'html'}
+        status, response_json = self._post('text', data=payload)
+
+        if status == 'OK':
             info_dict = {
                 'chat_id': str(response_json['result']['chat']['id']),
                 'message_id': str(response_json['result']['message_id'])
             }
             return 'OK', info_dict
         else:
-            response_json.pop('ok')
             return 'ERROR', response_json
 
-    def send_image_message(self, base64_encoded_image,
+    def send_image_message(self, image,
                            filename: str = '',
                            caption: str = '',
-                           as_document: bool = True) -> Tuple[str, Dict[str, Any]]:
-        file_content = base64.b64decode(base64_encoded_image)
-
-        with tempfile.TemporaryFile() as f, tempfile.TemporaryFile() as thumb_f:
-
-            f.write(file_content)
-            f.seek(0)
-
-            stream = io.BytesIO(file_content)
-            img = Image.open(stream).resize((320, 214))
-            img.save(thumb_f, "JPEG")
-            thumb_f.seek(0)
-
+                           as_document: bool = True,
+                           chat_id: str = None,
+                           file_id: str = None) -> Tuple[str, Dict[str, Any]]:
+        chat_id = chat_id or self.chat_id
+        if file_id:
+            # Already uploaded, e.g. to another chat. Nothing to upload again.
             if as_document:
-                payload = {'chat_id': self.chat_id, 'thumb': 'attach://preview_' + filename,
-                           'caption': caption}
-                files = {'document': (filename, f, 'image/jpeg'),
-                         'thumb': ('preview_' + filename, thumb_f, 'image/jpeg')}
-
-                send_image_response = requests.post(self.urls['doc'], data=payload, files=files)
+                payload = {'chat_id': chat_id, 'document': file_id, 'caption': caption}
+                status, response_json = self._post('doc', data=payload)
             else:
-                payload = {'chat_id': self.chat_id, 'caption': caption}
-                files = {'photo': (filename, f, 'image/jpeg')}
-                send_image_response = requests.post(self.urls['pic'], data=payload, files=files)
-
-            response_json = json.loads(send_image_response.text)
-
-            if response_json['ok']:
-                info_dict = {
-                    'chat_id': str(response_json['result']['chat']['id']),
-                    'message_id': str(response_json['result']['message_id'])
-                }
-                return 'OK', info_dict
+                payload = {'chat_id': chat_id, 'photo': file_id, 'caption': caption}
+                status, response_json = self._post('pic', data=payload)
+            if status == 'OK':
+                return 'OK', self.media_message_info(response_json)
             else:
-                response_json.pop('ok')
                 return 'ERROR', response_json
 
-    def edit_image_message(self, chat_id: str,
-                           message_id: str,
-                           base64_encoded_image,
-                           filename: str = '') -> Tuple[str, Dict[str, Any]]:
-        file_content = base64.b64decode(base64_encoded_image)
+        # Multipart bodies are built in memory straight from the image bytes, nothing touches the disk.
+        file_content = image_bytes(image)
 
-        with tempfile.TemporaryFile() as f:
-            f.write(file_content)
-            f.seek(0)
+        if as_document:
+            payload = {'chat_id': chat_id, 'thumb': 'attach://preview_' + filename,
+                       'caption': caption}
+            files = {'document': (filename, file_content, 'image/jpeg'),
+                     'thumb': ('preview_' + filename, self.thumbnail_service.thumbnail(file_content), 'image/jpeg')}
+
+            status, response_json = self._post('doc', data=payload, files=files)
+        else:
+            payload = {'chat_id': chat_id, 'caption': caption}
+            files = {'photo': (filename, file_content, 'image/jpeg')}
+            status, response_json = self._post('pic', data=payload, files=files)
+
+        if status == 'OK':
+            return 'OK', self.media_message_info(response_json)
+        else:
+            return 'ERROR', response_json
 
+    def edit_image_message(self, chat_id: str,
+                           message_id: str,
+                           image,
+                           filename: str = '',
+                           file_id: str = None) -> Tuple[str, Dict[str, Any]]:
+        if file_id:
+            # Already uploaded, e.g. to another chat. Nothing to upload again.
             payload = {'chat_id': chat_id, 'message_id': message_id,
-                       'media': json.dumps({'type': 'photo', 'media': 'attach://media'})}
-            files = {'media': (filename, f, 'image/jpeg')}
-
-            edit_image_message_response = requests.post(self.urls['edit_message_media'], data=payload, files=files)
-            response_json = json.loads(edit_image_message_response.text)
-
-            if response_json['ok']:
-                info_dict = {
-                    'chat_id': str(response_json['result']['chat']['id']),
-                    'message_id': str(response_json['result']['message_id'])
-                }
-                return 'OK', info_dict
+                       'media': json_codec.dumps({'type': 'photo', 'media': file_id})}
+            status, response_json = self._post('edit_message_media', data=payload)
+            if status == 'OK':
+                return 'OK', self.media_message_info(response_json)
             else:
-                response_json.pop('ok')
                 return 'ERROR', response_json
 
+        payload = {'chat_id': chat_id, 'message_id': message_id,
+                   'media': json_codec.dumps({'type': 'photo', 'media': 'attach://media'})}
+        files = {'media': (filename, image_bytes(image), 'image/jpeg')}
+
+        status, response_json = self._post('edit_message_media', data=payload, files=files)
+
+        if status == 'OK':
+            return 'OK', self.media_message_info(response_json)
+        else:
+            return 'ERROR', response_json
+
     def pin_message(self, chat_id: str, message_id: str) -> Tuple[str, Dict[str, Any]]:
         payload = {'chat_id': chat_id, 'message_id': message_id, 'disable_notification': True}
-        pin_message_response = requests.post(self.urls['pin_message'], data=payload)
-        response_json = json.loads(pin_message_response.text)
+        status, response_json = self._post('pin_message', data=payload)
 
-        if response_json['ok']:
+        if status == 'OK':
             return 'OK', dict()
         else:
-            response_json.pop('ok')
             return 'ERROR', response_json
 
     def unpin_message(self, chat_id: str, message_id: str) -> Tuple[str, Dict[str, Any]]:
         payload = {'chat_id': chat_id, 'message_id': message_id}
-        unpin_message_response = requests.post(self.urls['unpin_message'], data=payload)
-        response_json = json.loads(unpin_message_response.text)
+        status, response_json = self._post('unpin_message', data=payload)
 
-        if response_json['ok']:
-            info_dict = {
-                'chat_id': str(response_json['result']['chat']['id']),
-                'message_id': str(response_json['result']['message_id'])
-            }
-            return 'OK', info_dict
+        if status == 'OK':
+            # Telegram answers 'True', not the message
+            return 'OK', dict()
         else:
-            response_json.pop('ok')
             return 'ERROR', response_json
 
     def unpin_all_messages(self, chat_id: str) -> Tuple[str, Dict[str, Any]]:
         payload = {'chat_id': chat_id}
-        unpin_message_response = requests.post(self.urls['unpin_all_messages'], data=payload)
-        response_json = json.loads(unpin_message_response.text)
+        status, response_json = self._post('unpin_all_messages', data=payload)
 
-        if response_json['ok']:
+        if status == 'OK':
             return 'OK', dict()
         else:
-            response_json.pop('ok')
             return 'ERROR', response_json
 
 
@@ -157,16 +208,14 @@ if __name__ == '__main__':
     the_message_id = response[1]['message_id']
 
     with open("tests/ic5070.jpg", "rb") as image_file, open("tests/m42.jpg", "rb") as second_image_file:
-        encoded_string = base64.b64encode(image_file.read())
-        response = t.send_image_message(encoded_string, 'ic5070.jpg')
+        response = t.send_image_message(image_file.read(), 'ic5070.jpg')
         print(response)
 
         response = t.pin_message(chat_id=the_chat_id, message_id=the_message_id)
         print(response)
 
-        encoded_string = base64.b64encode(second_image_file.read())
         response = t.edit_image_message(chat_id=the_chat_id, message_id=the_message_id,
-                                        base64_encoded_image=encoded_string,
+                                        image=second_image_file.read(),
                                         filename='m42.jpg')
         print(response)
 
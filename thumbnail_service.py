@@ -0,0 +1,55 @@
+#!/bin/env python3
+import hashlib
+import io
+import threading
+from collections import OrderedDict
+from typing import Tuple, Union
+
+from PIL import Image
+
+
+class ThumbnailService:
+    """
+    Builds small JPEG thumbnails of images, keeping their aspect ratio.
+
+    JPEGs are decoded in draft mode: the decoder scales the DCT blocks down by 1/2, 1/4 or 1/8 while decoding,
+    so a full resolution preview is never materialized just to be thrown away. Thumbnails are cached by the
+    content of the image, since the same image is often thumbnailed for every chat it's sent to.
+    """
+
+    def __init__(self, max_size: Tuple[int, int] = (320, 320), quality: int = 85, cache_size: int = 16):
+        self.max_size = max_size
+        self.quality = quality
+        self.cache_size = cache_size
+
+        self.cache = OrderedDict()  # digest of the image => thumbnail, least recently used first
+        self.cache_lock = threading.Lock()
+
+    def thumbnail(self, image: Union[bytes, memoryview]) -> bytes:
+        """
+        :param image: Raw bytes of the image
+        :return: JPEG bytes of the thumbnail, at most 'max_size' large
+        """
+        key = hashlib.blake2b(image, digest_size=16).digest()
+        with self.cache_lock:
+            if key in self.cache:
+                self.cache.move_to_end(key)
+                return self.cache[key]
+
+        thumbnail = self.render(image)
+
+        with self.cache_lock:
+            self.cache[key] = thumbnail
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return thumbnail
+
+    def render(self, image: Union[bytes, memoryview]) -> bytes:
+        img = Image.open(io.BytesIO(image))
+        # Only JPEGs support draft mode, other formats ignore it and are decoded at full size
+        img.draft('RGB', self.max_size)
+        img.thumbnail(self.max_size)
+
+        thumbnail_bytes = io.BytesIO()
+        img.convert('RGB').save(thumbnail_bytes, format='JPEG', quality=self.quality)
+        return thumbnail_bytes.getvalue()
@@ -0,0 +1,33 @@
+#!/bin/env python3
+import threading
+import time
+
+
+class TokenBucket:
+    """
+    Thread safe token bucket rate limiter. Tokens refill at 'rate_per_sec' up to 'burst', every 'acquire' takes one.
+    """
+
+    def __init__(self, rate_per_sec: float = 1, burst: int = 1):
+        self.rate_per_sec = max(rate_per_sec, 0.001)
+        self.burst = max(1, burst)
+        self.tokens = float(self.burst)
+        self.last_refill_time = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self) -> float:
+        """
+        Take a token, sleeping until one is available. Callers are served in the order they called.
+        :return: How long the caller slept, in seconds.
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.last_refill_time) * self.rate_per_sec)
+            self.last_refill_time = now
+            # Take the token right away, even if it's not there yet: a negative balance is a reservation.
+            self.tokens -= 1
+            wait_sec = -self.tokens / self.rate_per_sec if self.tokens < 0 else 0.0
+
+        if wait_sec > 0:
+            time.sleep(wait_sec)
+        return wait_sec
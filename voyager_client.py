@@ -1,77 +1,196 @@
 #!/bin/env python3
+import time
 import traceback
 from collections import defaultdict
-from typing import Dict
+from types import MappingProxyType
+from typing import Callable, Dict, Set, Tuple
 
+from control_data_coalescer import ControlDataCoalescer, CONTROL_DATA_CHANGED
 from curse_manager import CursesManager
 from event_handlers.battery_status_event_handler import BatteryStatusEventHandler
 from event_handlers.giant_event_handler import GiantEventHandler
 from event_handlers.log_event_handler import LogEventHandler
 from event_handlers.misc_event_handler import MiscellaneousEventHandler
-from event_handlers.voyager_event_handler import VoyagerEventHandler
+from event_handlers.voyager_event_handler import VoyagerEventHandler, ALL_EVENTS
+from handler_lane import HandlerLane
 from html_telegram_bot import HTMLTelegramBot
+from outbound_telegram_scheduler import OutboundTelegramScheduler
+from sequence_stat import StatPlotter
 from telegram import TelegramBot
 
 
 class VoyagerClient:
-    def __init__(self, config=None):
+    """
+    Event handling side of a single rig. Resources that can be shared between rigs (telegram bot, curses screen,
+    stat plotter) are created here only when they are not passed in.
+    """
+
+    # Events made up by the bot itself. Greedy routes don't get them, they already saw the original event.
+    SYNTHETIC_EVENT_NAMES = (CONTROL_DATA_CHANGED,)
+    # Events handler lanes never drop. 'ControlDataChanged' is only sent when the state changes, so a dropped one
+    # would be a state transition handlers never hear about.
+    UNDROPPABLE_EVENT_NAMES = (CONTROL_DATA_CHANGED,)
+
+    def __init__(self, config=None, telegram_bot: OutboundTelegramScheduler = None,
+                 curses_manager: CursesManager = None, stat_plotter: StatPlotter = None,
+                 monitor_local_battery: bool = True):
         self.config = config
-        self.telegram_bot = None
-        self.curses_manager = CursesManager()
+        self.telegram_bot = telegram_bot
+        self.curses_manager = curses_manager or CursesManager()
+
+        if self.telegram_bot is None:
+            if self.config.debugging:
+                self.telegram_bot = OutboundTelegramScheduler.from_config(config, HTMLTelegramBot())
+            else:
+                self.telegram_bot = OutboundTelegramScheduler.from_config(config, TelegramBot(config=config))
 
-        if self.config.debugging:
-            self.telegram_bot = HTMLTelegramBot()
-        else:
-            self.telegram_bot = TelegramBot(config=config)
+        self.stat_plotter = stat_plotter or StatPlotter(plotter_configs=self.config.sequence_stats_config)
 
-        self.handler_dict = defaultdict(set)
-        self.greedy_handler_set = set()
+        self.event_handlers = list()
+        self.dispatch_table = MappingProxyType(dict())  # event name => tuple of routes (bound handler methods)
+        self.greedy_routes = tuple()
+        self.route_stats = dict()  # route => [number of calls, cumulative seconds]
+        self.handler_lanes = dict()  # event handler => its own lane, empty when lanes are disabled
+        self.control_data_coalescer = ControlDataCoalescer()
 
         miscellaneous_event_handler = MiscellaneousEventHandler(config=config, telegram_bot=self.telegram_bot,
                                                                 curses_manager=self.curses_manager)
         self.register_event_handler(miscellaneous_event_handler)
 
         giant_handler = GiantEventHandler(config=config, telegram_bot=self.telegram_bot,
-                                          curses_manager=self.curses_manager)
+                                          curses_manager=self.curses_manager, stat_plotter=self.stat_plotter)
         self.register_event_handler(giant_handler)
 
         log_event_handler = LogEventHandler(config=config, telegram_bot=self.telegram_bot,
                                             curses_manager=self.curses_manager)
         self.register_event_handler(log_event_handler)
 
-        client_status_event_handler = BatteryStatusEventHandler(config=config, telegram_bot=self.telegram_bot,
-                                                                curses_manager=self.curses_manager)
-        self.register_event_handler(client_status_event_handler)
+        if monitor_local_battery:
+            # Battery of the machine running the bot, one handler is enough no matter how many rigs there are.
+            client_status_event_handler = BatteryStatusEventHandler(config=config, telegram_bot=self.telegram_bot,
+                                                                    curses_manager=self.curses_manager)
+            self.register_event_handler(client_status_event_handler)
+
+        self.curses_manager.add_handler_lanes(self.handler_lanes.values())
 
     def parse_message(self, event_name: str, message: Dict):
-        if event_name in self.handler_dict:
-            for handler in self.handler_dict[event_name]:
-                try:
-                    handler.handle_event(event_name, message)
-                except Exception as exception:
-                    if 'Base64Data' in message:
-                        message.pop('Base64Data')
-
-                    print(f'\n[{handler.get_name()}] Exception occurred while handling {event_name}, '
-                          f'raw message: {message}, exception details:{exception}')
-                    traceback.print_exc()
-
-        for handler in self.greedy_handler_set:
-            try:
-                handler.handle_event(event_name, message)
-            except Exception as exception:
-                if 'Base64Data' in message:
-                    message.pop('Base64Data')
-
-                print(f'\n[{handler.get_name()}] Exception occurred while handling {event_name}, '
-                      f'raw message: {message}, exception details:{exception}')
-                traceback.print_exc()
+        if event_name == 'ControlData':
+            # State consumers only hear about changes, which happen a few times a night. Dispatched first,
+            # so that handlers know the current state by the time they get the guide sample of this 'ControlData'.
+            control_data_changed = self.control_data_coalescer.coalesce(message)
+            if control_data_changed is not None and CONTROL_DATA_CHANGED in self.dispatch_table:
+                self.dispatch(CONTROL_DATA_CHANGED, control_data_changed)
+        self.dispatch(event_name, message)
+
+    def dispatch(self, event_name: str, message: Dict):
+        for route in self.dispatch_table.get(event_name, self.greedy_routes):
+            handler_lane = self.handler_lanes.get(route.__self__)
+            if handler_lane is None:
+                self.run_route(event_name, route, message)
+            else:
+                handler_lane.put(event_name, route, message)
+
+    def run_route(self, event_name: str, route: Callable, message: Dict):
+        start_time = time.perf_counter()
+        try:
+            route(message)
+        except Exception as exception:
+            print(f'\n[{route.__self__.get_name()}] Exception occurred while handling {event_name}, '
+                  f'raw message: {message}, exception details:{exception}')
+            traceback.print_exc()
+        # Stats of the same route are only ever updated by the lane of its handler
+        route_stat = self.route_stats[route]
+        route_stat[0] += 1
+        route_stat[1] += time.perf_counter() - start_time
+
+    def handled_event_names(self) -> Set[str]:
+        """
+        :return: Names of the events that at least one handler explicitly registered for. Greedy handlers don't count.
+        """
+        return set(self.dispatch_table.keys())
 
     def register_event_handler(self, event_handler: VoyagerEventHandler):
-        if event_handler.interested_event_name():
-            self.handler_dict[event_handler.interested_event_name()].add(event_handler)
-        if event_handler.interested_event_names():
-            for v in event_handler.interested_event_names():
-                self.handler_dict[v].add(event_handler)
-        if event_handler.interested_in_all_events():
-            self.greedy_handler_set.add(event_handler)
+        self.event_handlers.append(event_handler)
+        lanes_config = self.config.handler_lanes
+        if lanes_config.enabled:
+            handler_name = event_handler.get_name()
+            max_sizes = lanes_config.max_sizes or dict()
+            self.handler_lanes[event_handler] = HandlerLane(
+                handler_name=event_handler.with_rig_label(handler_name), run_route=self.run_route,
+                max_size=max_sizes.get(handler_name, lanes_config.max_size),
+                overflow_policy=lanes_config.overflow_policy, undroppable_event_names=self.UNDROPPABLE_EVENT_NAMES)
+        self.compile_dispatch_table()
+
+    def start_handler_lanes(self):
+        for handler_lane in self.handler_lanes.values():
+            handler_lane.start()
+
+    def wait_until_idle(self, timeout: float = None) -> bool:
+        """
+        Wait until every lane handled everything queued so far.
+        :return: False if some lane was still busy after 'timeout' seconds.
+        """
+        return all([handler_lane.wait_until_idle(timeout) for handler_lane in self.handler_lanes.values()])
+
+    def stop_handler_lanes(self):
+        for handler_lane in self.handler_lanes.values():
+            handler_lane.stop()
+        for event_handler in self.event_handlers:
+            event_handler.flush()
+
+    def compile_dispatch_table(self):
+        """
+        Build the read-only table of event name => tuple of routes, so that dispatching a message is a single lookup.
+        Routes are ordered by handler registration order, then by method definition order,
+        and greedy routes come after all routes registered for that specific event, unless the event is synthetic.
+        """
+        routes_by_event_name = defaultdict(list)
+        greedy_routes = list()
+        for event_handler in self.event_handlers:
+            for event_name, route in event_handler.routes():
+                if event_name == ALL_EVENTS:
+                    greedy_routes.append(route)
+                else:
+                    routes_by_event_name[event_name].append(route)
+
+        self.greedy_routes = tuple(greedy_routes)
+        dispatch_table = dict()
+        for event_name, routes in routes_by_event_name.items():
+            if event_name in self.SYNTHETIC_EVENT_NAMES:
+                dispatch_table[event_name] = tuple(routes)
+            else:
+                dispatch_table[event_name] = tuple(routes) + self.greedy_routes
+        self.dispatch_table = MappingProxyType(dispatch_table)
+        for route in self.greedy_routes:
+            self.route_stats.setdefault(route, [0, 0.0])
+        for routes in self.dispatch_table.values():
+            for route in routes:
+                self.route_stats.setdefault(route, [0, 0.0])
+
+    def instrument_routes(self, route_wrapper: Callable = None):
+        """
+        Swap in a dispatch table with every route replaced by 'route_wrapper(route)', e.g. for profiling.
+        Passing None restores the compiled routes. Tables are swapped as a whole, so there is no cost when unused.
+        """
+        if route_wrapper is None:
+            self.compile_dispatch_table()
+            return
+
+        routes = set(self.greedy_routes)
+        for event_routes in self.dispatch_table.values():
+            routes.update(event_routes)
+        wrapped_routes = {route: route_wrapper(route) for route in routes}
+        for route, wrapped_route in wrapped_routes.items():
+            # Wrapped routes count towards the same stats as the original ones
+            self.route_stats[wrapped_route] = self.route_stats[route]
+
+        self.greedy_routes = tuple(wrapped_routes[route] for route in self.greedy_routes)
+        self.dispatch_table = MappingProxyType({event_name: tuple(wrapped_routes[route] for route in routes)
+                                               for event_name, routes in self.dispatch_table.items()})
+
+    def route_stat_report(self) -> Dict[str, Tuple[int, float]]:
+        """
+        :return: Dictionary of 'handler name.method name' => (number of calls, cumulative seconds)
+        """
+        return {f'{route.__self__.get_name()}.{route.__name__}': (calls, total_sec)
+                for route, (calls, total_sec) in list(self.route_stats.items())}
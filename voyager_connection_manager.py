@@ -1,185 +1,287 @@
 #!/usr/bin/env python3
 
-from concurrent.futures import ThreadPoolExecutor
-import _thread
-import json
+import asyncio
 import base64
 import time
+import traceback
 import uuid
-from collections import deque
-from datetime import datetime
-import websocket
+from collections import deque, OrderedDict
+
+import websockets
+
+import json_codec
 from configs import ConfigBuilder
-from log_writer import LogWriter
-import asyncio
-from threading import Thread
+from data_structure.pending_command import PendingCommand
+from event_filter import EventFilter
+from heartbeat_monitor import HeartbeatMonitor
+from reconnect_backoff import ReconnectBackoff
 
 
-class VoyagerConnectionManager(Thread):
+class VoyagerConnectionManager:
     """
     Low level class that maintains a live connection with voyager application server.
-    It allows command sending, keep-alive, reconnect, etc.
-    Logic to understand the content of each packet lives in 'VoyagerClient'.
-    TODO: Consider reverse the order of creation. Maybe let voyager client create an instance of connection manager.
+    It owns the socket, keep-alive, reconnect and command futures, all of them on a single asyncio event loop.
+    Logic to understand the content of each packet lives in 'VoyagerClient', every received frame is handed over
+    untouched to 'receive_message_callback'.
     """
 
-    def __init__(self, config = None, thread_id: str = 'WSThread'):
-        Thread.__init__(self)
-        self.thread_id = thread_id
-        self.wst = None
-
+    def __init__(self, config=None, receive_message_callback=None):
         self.config = config
         self.voyager_settings = self.config.voyager_setting
+        self.receive_message_callback = receive_message_callback
 
         self.ws = None
-        self.keep_alive_thread = None
-        self.command_queue = deque([])
-        self.ongoing_command = None
-        self.current_command_future = None
+        self.keep_alive_task = None
+        self.handshake_task = None
+        self.session_tasks = list()
+
+        # Commands that set up server side state of a connection, replayed on every (re)connect
+        self.subscriptions = [('RemoteSetDashboardMode', {'IsOn': True}),
+                              ('RemoteSetLogEvent', {'IsOn': True, 'Level': 0})]
+        # Commands that re-fetch state which might have changed while we were disconnected
+        self.resync_commands = [('RemoteGetFilterConfiguration', {})]
+
+        self.command_queue = deque([])  # commands waiting for a free slot in the in-flight window
+        self.in_flight_commands = dict()  # command id => command that was sent and not replied yet
         self.next_id = 1
 
-        self.log_writer = LogWriter(config=config)
-
-        self.reconnect_delay_sec = 1
-        self.should_exit_keep_alive_thread = False
-
-        self.receive_message_callback = None
-        self.bootstrap = None
-        self.loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(self.loop)
-
-    async def send_command(self, command_name, params, ):
-        print('sending command..' + command_name)
-        params['UID'] = str(uuid.uuid1())
+        command_dispatch_config = self.config.command_dispatch
+        self.command_window_size = max(1, command_dispatch_config.window_size)
+        self.command_timeout_sec = command_dispatch_config.timeout_sec
+        self.command_max_retries = command_dispatch_config.max_retries
+        self.max_tracked_uids = command_dispatch_config.max_tracked_uids
+
+        reconnect_config = self.config.reconnect
+        self.reconnect_backoff = ReconnectBackoff(initial_delay_sec=reconnect_config.initial_delay_sec,
+                                                  max_delay_sec=reconnect_config.max_delay_sec,
+                                                  jitter_ratio=reconnect_config.jitter_ratio)
+        self.connected_timestamp = None
+        self.reconnect_immediately = False
+
+        self.heartbeat_monitor = HeartbeatMonitor(interval_sec=self.config.heartbeat.interval_sec,
+                                                  max_missed_intervals=self.config.heartbeat.max_missed_intervals)
+
+        # 'RemoteActionResult' events arrive after the 'jsonrpc' reply, so this can't be cleaned up on reply.
+        # Only the most recent 'max_tracked_uids' entries are kept instead.
+        self.command_uid_to_method_name_dict = OrderedDict()
+
+    async def send_command(self, command_name, params):
+        """
+        Send a command to voyager application server. Up to 'window_size' commands are in flight at the same time,
+        replies are matched by 'id', and commands without reply are re-sent after 'timeout_sec'.
+        :return: The 'jsonrpc' reply of this command, available the moment it arrives.
+        :raise asyncio.TimeoutError: If the command was not replied after all retries.
+        :raise ConnectionError: If the connection was closed before the command was replied.
+        """
+        command_uuid = str(uuid.uuid1())
+        params['UID'] = command_uuid
         command = {
             'method': command_name,
             'params': params,
             'id': self.next_id
         }
         self.next_id = self.next_id + 1
-        event_loop = asyncio.get_event_loop()
-        future = event_loop.create_future()
-        # future = asyncio.Future()
-
-        self.command_queue.append((command, future))
-        self.try_to_process_next_command()
-        print('about to wait for a future, related to command ' + command_name, future)
-        while not future.done():
-            await asyncio.sleep(1)
-        await future
-        result = future.result()
-        print('a previous future was complete, result is: ' + str(result), future)
-        return result
-
-    def try_to_process_next_command(self):
-        if self.ongoing_command is not None:
-            print('wait a while before sending out the second command.')
-            # this command will be invoked later for sure
-            return
 
-        if len(self.command_queue) == 0:
+        self.command_uid_to_method_name_dict[command_uuid] = command_name
+        while len(self.command_uid_to_method_name_dict) > self.max_tracked_uids:
+            self.command_uid_to_method_name_dict.popitem(last=False)
+
+        pending_command = PendingCommand(command=command, future=asyncio.get_running_loop().create_future())
+        self.command_queue.append(pending_command)
+        await self.try_to_process_next_command()
+        return await pending_command.future
+
+    async def try_to_process_next_command(self):
+        while self.command_queue and len(self.in_flight_commands) < self.command_window_size:
+            pending_command = self.command_queue.popleft()
+            if pending_command.future.done():
+                # caller is gone, no need to send it out
+                continue
+
+            command_id = pending_command.command['id']
+            self.in_flight_commands[command_id] = pending_command
+            pending_command.timeout_handle = asyncio.get_running_loop().call_later(
+                self.command_timeout_sec, self.on_command_timeout, command_id)
+            await self.ws.send(json_codec.dumps(pending_command.command) + '\r\n')
+
+    def on_command_timeout(self, command_id: int):
+        pending_command = self.in_flight_commands.pop(command_id, None)
+        if pending_command is None or pending_command.future.done():
             return
 
-        command, future = self.command_queue.popleft()
-        print('Trying to send out command' + str(command))
-        self.ongoing_command = command
-        self.current_command_future = future
-        self.ws.send(json.dumps(command) + '\r\n')
-        print('Sending command done')
-
-    def on_message(self, ws, message_string):
-        if not message_string or not message_string.strip():
-            # Empty message string, nothing to do
+        method_name = pending_command.command['method']
+        if pending_command.attempt < self.command_max_retries:
+            pending_command.attempt += 1
+            print(f'\n[{method_name}] No reply after {self.command_timeout_sec} sec, '
+                  f'retrying ({pending_command.attempt}/{self.command_max_retries})')
+            # Retried commands jump the queue, they were sent first in the first place. Keep them ordered by id.
+            index = 0
+            while index < len(self.command_queue) and self.command_queue[index].command['id'] < command_id:
+                index += 1
+            self.command_queue.insert(index, pending_command)
+        else:
+            pending_command.future.set_exception(
+                asyncio.TimeoutError(f'{method_name} was not replied after {pending_command.attempt + 1} attempts.'))
+        asyncio.get_running_loop().create_task(self.try_to_process_next_command())
+
+    def method_name_for_uid(self, uid: str) -> str:
+        return self.command_uid_to_method_name_dict.get(uid, 'NOT_FOUND')
+
+    async def on_command_reply(self, message_string: str):
+        try:
+            reply = json_codec.loads(message_string)
+        except ValueError as exception:
+            # A broken frame is not worth the connection, drop it. Its command times out and is retried.
+            print(f'\n[Command Reply] Dropped a malformed reply: {exception}')
             return
-
-        message = json.loads(message_string)
-        self.log_writer.write_line(message_string)
-
-        if 'jsonrpc' in message:
-            print('received a message that looks like a method result')
-            # some command finished, try to see if we have anything else.
-            self.ongoing_command = None
-            print('setting future result to' + str(message), self.current_command_future)
-            self.current_command_future.set_result(message)
-            print('setting future result done', self.current_command_future)
-            self.try_to_process_next_command()
+        if not isinstance(reply, dict):
+            print(f'\n[Command Reply] Dropped a reply that is not an object: {message_string[:64]}')
             return
-
-        event = message['Event']
-        #self.voyager_client.parse_message(event, message)
-        if self.receive_message_callback:
-            self.receive_message_callback(event, message)
-
-    def on_error(self, ws, error):
-        self.log_writer.maybe_flush()
-        print("### {error} ###".format(error=error))
-
-    def on_close(self, ws, close_status_code, close_msg):
-        print("### [{code}] {msg} ###".format(code=close_status_code, msg=close_msg))
-        # try to reconnect with an exponentially increasing delay
-        if self.config.allow_auto_reconnect:
-            time.sleep(self.reconnect_delay_sec)
-            if self.reconnect_delay_sec < 512:
-                # doubles the reconnect delay so that we don't DOS server.
-                self.reconnect_delay_sec = self.reconnect_delay_sec * 2
-            # reset keep alive thread
-            self.should_exit_keep_alive_thread = True
-            self.keep_alive_thread = None
-            self.run_forever()
-
-    def on_open(self, ws):
-        # Reset the reconnection delay to 1 sec
-        # if self.bootstrap:
-        #    task = self.loop.create_task(self.bootstrap())
-        #    self.loop.run_until_complete(task)
-
-        self.reconnect_delay_sec = 1
-
-        if self.keep_alive_thread is None:
-            self.should_exit_keep_alive_thread = False
-            self.keep_alive_thread = _thread.start_new_thread(self.keep_alive_routine, ())
-
-    def run_forever(self):
-        print(str(self.thread_id) + " Starting thread")
-
-        self.ws = websocket.WebSocketApp(
-            'ws://{server_url}:{port}/'.format(server_url=self.voyager_settings.domain,
-                                               port=self.voyager_settings.port),
-            on_open=self.on_open,
-            on_message=self.on_message,
-            on_error=self.on_error,
-            on_close=self.on_close)
-        self.ws.keep_running = True
-        self.wst = Thread(target=self.ws.run_forever)
-        self.wst.daemon = True
-        self.wst.start()
-
-    def keep_alive_routine(self):
-        while not self.should_exit_keep_alive_thread:
-            self.ws.send('{"Event":"Polling","Timestamp":%d,"Inst":1}\r\n' % time.time())
-            time.sleep(5)
-
-
-async def main():
-    websocket.enableTrace(True)
-    c = ConfigBuilder()
-    connection_manager = VoyagerConnectionManager(c)
-    connection_manager.run_forever()
-
-    time.sleep(1)
-
-    auth_token = f'{connection_manager.voyager_settings.username}:{connection_manager.voyager_settings.password}'
-    encoded_token = base64.urlsafe_b64encode(auth_token.encode('ascii'))
-    result = await connection_manager.send_command('AuthenticateUserBase',
-                                                   {'Base': encoded_token.decode('ascii')})
-    print(result, 'step 1')
-
-    result = await connection_manager.send_command('RemoteSetDashboardMode', {'IsOn': True})
-    print(result, 'step 2')
-
-    result = await connection_manager.send_command('RemoteSetLogEvent', {'IsOn': True, 'Level': 0})
-    print(result, 'step 3')
+        pending_command = self.in_flight_commands.pop(reply.get('id'), None)
+        if pending_command is not None:
+            pending_command.timeout_handle.cancel()
+            if not pending_command.future.done():
+                pending_command.future.set_result(reply)
+        # some command finished, try to see if we have anything else.
+        await self.try_to_process_next_command()
+
+    async def receive_routine(self):
+        async for message_string in self.ws:
+            if not message_string or message_string.isspace():
+                # Empty message string, nothing to do
+                continue
+
+            self.heartbeat_monitor.on_frame_received(EventFilter.event_name(message_string))
+
+            # Command replies are tiny and always start with the 'jsonrpc' key, don't scan the whole frame.
+            if message_string.find('"jsonrpc"', 0, 64) != -1:
+                await self.on_command_reply(message_string)
+
+            if self.receive_message_callback:
+                self.receive_message_callback(message_string)
+
+    async def keep_alive_routine(self):
+        while True:
+            if self.heartbeat_monitor.is_dead():
+                last_rtt, average_rtt, max_rtt = self.heartbeat_monitor.rtt_stats()
+                print(f'\n[Heartbeat] Nothing received for {self.heartbeat_monitor.missed_intervals()} intervals, '
+                      f'RTT last/avg/max: {last_rtt:.3f}/{average_rtt:.3f}/{max_rtt:.3f} sec')
+                # A dead link is not worth waiting for, reconnect right away.
+                self.reconnect_immediately = True
+                raise ConnectionError('Heartbeat lost, connection to voyager application server is dead.')
+
+            await self.ws.send('{"Event":"Polling","Timestamp":%d,"Inst":1}\r\n' % time.time())
+            self.heartbeat_monitor.on_polling_sent()
+            await asyncio.sleep(self.heartbeat_monitor.interval_sec)
+
+    async def handshake(self):
+        """
+        Authenticate, replay all subscriptions and re-fetch state that might have changed while disconnected.
+        All these commands are pipelined, so this costs one round trip instead of one per command.
+        """
+        startup_commands = list()
+        if hasattr(self.voyager_settings, 'username'):
+            auth_token = f'{self.voyager_settings.username}:{self.voyager_settings.password}'
+            encoded_token = base64.urlsafe_b64encode(auth_token.encode('ascii'))
+            startup_commands.append(self.send_command('AuthenticateUserBase', {'Base': encoded_token.decode('ascii')}))
+
+        for command_name, params in self.subscriptions + self.resync_commands:
+            # 'send_command' stamps an UID into params, so each replay gets a fresh copy.
+            startup_commands.append(self.send_command(command_name, dict(params)))
+
+        results = await asyncio.gather(*startup_commands, return_exceptions=True)
+        errors = [result for result in results if isinstance(result, Exception)]
+        if errors:
+            print(f'\n[Handshake] {len(errors)} startup commands failed: {errors}')
+        else:
+            # Only a connection that made it through the handshake counts as a successful reconnect.
+            self.reconnect_backoff.reset()
+            print(f'\n[Handshake] Ready in {time.monotonic() - self.connected_timestamp:.3f} sec')
+
+    async def run_session(self, url: str):
+        """
+        Lives exactly as long as one connection. Returns once the socket is closed or the keep-alive failed,
+        and always leaves nothing behind: see 'teardown_session'.
+        """
+        # Previews are sent as multi-megabyte frames, so don't limit the frame size.
+        # Liveness is tracked by 'heartbeat_monitor', and closing a dead link shouldn't wait long for an answer.
+        async with websockets.connect(url, ping_interval=None, max_size=None, close_timeout=1) as ws:
+            self.ws = ws
+            self.connected_timestamp = time.monotonic()
+            self.heartbeat_monitor.reset()
+            loop = asyncio.get_running_loop()
+            receive_task = loop.create_task(self.receive_routine())
+            self.keep_alive_task = loop.create_task(self.keep_alive_routine())
+            # Handshake waits for replies, which are only read by 'receive_routine', so it can't block it.
+            self.handshake_task = loop.create_task(self.handshake())
+            self.session_tasks = [receive_task, self.keep_alive_task, self.handshake_task]
+
+            await asyncio.wait({receive_task, self.keep_alive_task}, return_when=asyncio.FIRST_COMPLETED)
+            for task in (receive_task, self.keep_alive_task):
+                if task.done() and not task.cancelled() and task.exception() is not None:
+                    raise task.exception()
+        print(f'Closing connection, Code={ws.close_code}, description= {ws.close_reason}')
+
+    async def teardown_session(self):
+        """
+        Stops every task of the previous connection and waits until they are really gone,
+        so nothing from an old connection can ever write to a new socket.
+        """
+        for task in self.session_tasks:
+            task.cancel()
+        await asyncio.gather(*self.session_tasks, return_exceptions=True)
+        self.session_tasks = list()
+        self.keep_alive_task = None
+        self.handshake_task = None
+
+        pending_commands = list(self.command_queue) + list(self.in_flight_commands.values())
+        for pending_command in pending_commands:
+            if pending_command.timeout_handle is not None:
+                pending_command.timeout_handle.cancel()
+            if not pending_command.future.done():
+                pending_command.future.set_exception(
+                    ConnectionError('Connection to voyager application server was closed.'))
+        self.command_queue.clear()
+        self.in_flight_commands.clear()
+
+        if self.ws is not None:
+            await self.ws.close()
+            self.ws = None
+
+    async def run_forever(self):
+        """
+        Reconnect supervisor. Owns the connection lifecycle in a plain loop: connect, run one session, tear it down,
+        back off with jitter, repeat.
+        """
+        url = 'ws://{server_url}:{port}/'.format(server_url=self.voyager_settings.domain,
+                                                  port=self.voyager_settings.port)
+        while True:
+            try:
+                await self.run_session(url)
+            except (OSError, asyncio.TimeoutError, websockets.exceptions.WebSocketException) as exception:
+                print(f'Error: {exception} ###')
+            except Exception as exception:
+                # Anything else is a bug in a session, not a reason to leave this rig, or every rig, disconnected.
+                # Cancellation is not an 'Exception', so stopping the bot still ends the loop.
+                print(f'\n[{type(self).__name__}] Unexpected error in session: {type(exception).__name__}: {exception}')
+                traceback.print_exc()
+            finally:
+                await self.teardown_session()
+
+            if not self.config.allow_auto_reconnect:
+                return
+
+            if self.reconnect_immediately:
+                self.reconnect_immediately = False
+                continue
+
+            delay_sec = self.reconnect_backoff.next_delay_sec()
+            print(f'Reconnecting in {delay_sec:.1f} sec')
+            await asyncio.sleep(delay_sec)
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    config_builder = ConfigBuilder()
+    connection_manager = VoyagerConnectionManager(config=config_builder.build(),
+                                                  receive_message_callback=print)
+    asyncio.run(connection_manager.run_forever())